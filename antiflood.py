@@ -0,0 +1,118 @@
+import logging
+import re
+import time
+
+log = logging.getLogger(__name__)
+
+_TRAILING_ID = re.compile(r"_\d+$")
+
+# действие -> (токенов в секунду, ёмкость); "*" — общий лимит пользователя
+DEFAULT_LIMITS = {
+    "*": (5.0, 10),
+    "start": (1.0, 3),
+    "claim": (0.5, 2),
+    "promo": (0.5, 2),
+    "cb": (2.0, 5),
+    "wd": (0.5, 2),
+    "message": (2.0, 5),
+}
+
+
+def update_action(update):
+    """Короткое имя действия для лимита: claim/promo/start, wd, cb:<data>, message"""
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        if data.startswith("wd_"):
+            return "wd"
+        return "cb:" + _TRAILING_ID.sub("", data)
+    if update.message is not None:
+        text = update.message.text or ""
+        if text.startswith("/start"):
+            arg = text[6:].strip()
+            if arg.startswith("claim_"):
+                return "claim"
+            if arg.startswith("promo_"):
+                return "promo"
+            return "start"
+        return "message"
+    return None
+
+
+class AntiFlood:
+    """
+    Middleware диспетчера: token bucket на пользователя и на пару (пользователь, действие).
+    Бакеты — плоский dict key -> [tokens, updated], простаивающие выкидываются периодически.
+    Лишние callback'и получают пустой call.answer(), лишние сообщения просто отбрасываются —
+    до БД и edit_text дело не доходит.
+    """
+
+    def __init__(self, limits=None, exempt=(), idle_ttl=300, sweep_every=10000):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.exempt = set(exempt)
+        self.idle_ttl = idle_ttl
+        self.sweep_every = sweep_every
+        self._buckets = {}
+        self._ops = 0
+        self.dropped = {}
+        self.skipped_renders = 0
+
+    def _limit(self, action):
+        if action.startswith("cb:"):
+            return self.limits.get(action, self.limits["cb"])
+        return self.limits.get(action, self.limits["message"])
+
+    def _take(self, key, rate, capacity, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._buckets[key] = [capacity - 1, now]
+            return True
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True
+        bucket[0] = tokens
+        return False
+
+    def allow(self, user_id, action, now=None):
+        now = now or time.monotonic()
+        self._ops += 1
+        if self._ops % self.sweep_every == 0:
+            self.sweep(now)
+        rate, capacity = self.limits["*"]
+        if not self._take(user_id, rate, capacity, now):
+            return False
+        rate, capacity = self._limit(action)
+        return self._take((user_id, action), rate, capacity, now)
+
+    def sweep(self, now=None):
+        now = now or time.monotonic()
+        idle = [k for k, b in self._buckets.items() if now - b[1] > self.idle_ttl]
+        for k in idle:
+            del self._buckets[k]
+        return len(idle)
+
+    async def middleware(self, handler, update, data):
+        action = update_action(update)
+        event = update.callback_query or update.message
+        user = getattr(event, "from_user", None)
+        if action is None or user is None or user.id in self.exempt:
+            return await handler(update, data)
+        if self.allow(user.id, action):
+            return await handler(update, data)
+        # счётчик по грубому действию: cb:<data> приходит от клиента и не должен плодить ключи
+        kind = action.split(":", 1)[0]
+        self.dropped[kind] = self.dropped.get(kind, 0) + 1
+        if update.callback_query is not None:
+            try:
+                await update.callback_query.answer()
+            except Exception:
+                pass
+        return None
+
+    def stats(self):
+        out = {"buckets": len(self._buckets), "dropped": sum(self.dropped.values()),
+               "skipped_renders": self.skipped_renders}
+        for kind, count in self.dropped.items():
+            out["dropped_" + kind] = count
+        return out
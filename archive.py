@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import time
+
+import aiosqlite
+
+from counters import ALL_TIME
+from migrations import legacy_activations_pending
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checks (
+    check_id TEXT PRIMARY KEY,
+    creator_id INTEGER,
+    total_stars INTEGER,
+    activations_left INTEGER,
+    stars_per_activation INTEGER,
+    expires_at INTEGER,
+    archived_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS check_activations (
+    check_id TEXT,
+    user_id INTEGER,
+    PRIMARY KEY (check_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS promo_codes (
+    id INTEGER PRIMARY KEY,
+    code TEXT,
+    stars INTEGER,
+    activations_left INTEGER,
+    archived_at INTEGER
+);
+CREATE TABLE IF NOT EXISTS promo_activations (
+    promo_id INTEGER,
+    user_id INTEGER,
+    PRIMARY KEY (promo_id, user_id)
+) WITHOUT ROWID;
+"""
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Archiver:
+    """
+    Фоновое обслуживание горячих таблиц:
+    - истёкшие чеки (expires_at) закрываются, остаток оплаченных (funded) возвращается создателю
+      проводкой check_expired;
+    - закончившиеся чеки и промокоды вместе с активациями переезжают в отдельный файл архива;
+    - освободившиеся страницы отдаются ОС через PRAGMA incremental_vacuum.
+    Всё пачками по batch_size строк: каждая пачка — своя короткая транзакция, между ними пауза.
+    Строки сначала пишутся в архив (INSERT OR REPLACE), потом удаляются из основной базы —
+    после падения между шагами пачка просто повторится. Id промокодов в архиве не повторяются:
+    promo_codes.id — AUTOINCREMENT, а при открытии архива его максимум резервируется в sqlite_sequence.
+    """
+
+    def __init__(self, database, ledger, counters, path, batch_size=200, pause=0.05, vacuum_pages=256,
+                 updates_ttl=86400):
+        self.database = database
+        self.ledger = ledger
+        self.counters = counters
+        self.path = path
+        self.batch_size = batch_size
+        self.pause = pause
+        self.vacuum_pages = vacuum_pages
+        self.updates_ttl = updates_ttl
+        self._archive = None
+        self._vacuum_warned = False
+        self.expired = 0
+        self.refunded = 0
+        self.archived_checks = 0
+        self.archived_promos = 0
+        self.archived_activations = 0
+        self.vacuumed_pages = 0
+        self.pruned_updates = 0
+        self.last_run_s = 0.0
+
+    async def _open_archive(self):
+        if self._archive is None:
+            self._archive = await aiosqlite.connect(self.path)
+            await self._archive.execute("PRAGMA journal_mode=WAL")
+            await self._archive.executescript(ARCHIVE_SCHEMA)
+            await self._archive.commit()
+            await self._reserve_promo_ids(self._archive)
+        return self._archive
+
+    async def _reserve_promo_ids(self, archive):
+        """Id, архивированные до AUTOINCREMENT (v9), не должны выдаваться новым промокодам"""
+        cur = await archive.execute("SELECT max(id) FROM promo_codes")
+        archived_max = (await cur.fetchone())[0]
+        if archived_max is None:
+            return
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute(
+                "UPDATE sqlite_sequence SET seq = ? WHERE name = 'promo_codes' AND seq < ?",
+                (archived_max, archived_max)
+            )
+            await db.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'promo_codes', ? "
+                "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'promo_codes')",
+                (archived_max,)
+            )
+            await db.commit()
+
+    async def close(self):
+        if self._archive is not None:
+            await self._archive.close()
+            self._archive = None
+
+    async def _select(self, sql, params):
+        # чтение в WAL не блокирует обработчики
+        async with self.database.acquire() as db:
+            cur = await db.execute(sql, params)
+            return await cur.fetchall()
+
+    async def _copy_then_delete(self, rows, copy_sql, delete_sql, keys):
+        archive = await self._open_archive()
+        await archive.executemany(copy_sql, rows)
+        await archive.commit()
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.executemany(delete_sql, keys)
+            await db.commit()
+        await asyncio.sleep(self.pause)
+
+    async def expire_checks(self):
+        """Закрывает истёкшие чеки и возвращает создателям неизрасходованные звёзды (кроме неоплаченных)"""
+        total = 0
+        while True:
+            async with self.database.acquire() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                cur = await db.execute(
+                    "SELECT check_id, creator_id, activations_left * stars_per_activation * funded FROM checks "
+                    "WHERE expires_at <= ? AND activations_left > 0 LIMIT ?",
+                    (int(time.time()), self.batch_size)
+                )
+                rows = await cur.fetchall()
+                if not rows:
+                    await db.rollback()
+                    break
+                await db.executemany("UPDATE checks SET activations_left = 0 WHERE check_id=?", [(r[0],) for r in rows])
+                refunds = [(creator_id, amount, check_id) for check_id, creator_id, amount in rows if amount > 0]
+                await self.ledger.credit_many(db, refunds, "check_expired")
+                await self.counters.bump(db, "checks_active", -len(rows), day=ALL_TIME)
+                await db.commit()
+            total += len(rows)
+            self.refunded += sum(amount for _, amount, _ in refunds)
+            await asyncio.sleep(self.pause)
+        self.expired += total
+        return total
+
+    async def archive_checks(self):
+        moved = 0
+        while True:
+            ids = [r[0] for r in await self._select(
+                "SELECT check_id FROM checks WHERE activations_left <= 0 LIMIT ?", (self.batch_size,)
+            )]
+            if not ids:
+                return moved
+            marks = ",".join("?" * len(ids))
+            # сначала активации (закончившийся чек новых уже не получит), потом сам чек
+            while True:
+                activations = await self._select(
+                    f"SELECT check_id, user_id FROM check_activations WHERE check_id IN ({marks}) LIMIT ?",
+                    (*ids, self.batch_size * 5)
+                )
+                if not activations:
+                    break
+                await self._copy_then_delete(
+                    activations,
+                    "INSERT OR REPLACE INTO check_activations (check_id, user_id) VALUES (?, ?)",
+                    "DELETE FROM check_activations WHERE check_id=? AND user_id=?",
+                    activations,
+                )
+                self.archived_activations += len(activations)
+            rows = await self._select(
+                "SELECT check_id, creator_id, total_stars, activations_left, stars_per_activation, expires_at "
+                f"FROM checks WHERE check_id IN ({marks})", ids
+            )
+            now = int(time.time())
+            await self._copy_then_delete(
+                [(*row, now) for row in rows],
+                "INSERT OR REPLACE INTO checks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                "DELETE FROM checks WHERE check_id=? AND activations_left <= 0",
+                [(row[0],) for row in rows],
+            )
+            moved += len(rows)
+            self.archived_checks += len(rows)
+
+    async def archive_promos(self):
+        moved = 0
+        while True:
+            ids = [r[0] for r in await self._select(
+                "SELECT id FROM promo_codes WHERE activations_left <= 0 LIMIT ?", (self.batch_size,)
+            )]
+            if not ids:
+                return moved
+            marks = ",".join("?" * len(ids))
+            while True:
+                activations = await self._select(
+                    f"SELECT promo_id, user_id FROM promo_activations WHERE promo_id IN ({marks}) LIMIT ?",
+                    (*ids, self.batch_size * 5)
+                )
+                if not activations:
+                    break
+                await self._copy_then_delete(
+                    activations,
+                    "INSERT OR REPLACE INTO promo_activations (promo_id, user_id) VALUES (?, ?)",
+                    "DELETE FROM promo_activations WHERE promo_id=? AND user_id=?",
+                    activations,
+                )
+                self.archived_activations += len(activations)
+            rows = await self._select(
+                f"SELECT id, code, stars, activations_left FROM promo_codes WHERE id IN ({marks})", ids
+            )
+            now = int(time.time())
+            await self._copy_then_delete(
+                [(*row, now) for row in rows],
+                "INSERT OR REPLACE INTO promo_codes VALUES (?, ?, ?, ?, ?)",
+                "DELETE FROM promo_codes WHERE id=? AND activations_left <= 0",
+                [(row[0],) for row in rows],
+            )
+            moved += len(rows)
+            self.archived_promos += len(rows)
+
+    async def prune_updates(self):
+        """processed_updates нужны, только пока супервизор может повторить апдейт — старше updates_ttl удаляются"""
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                "DELETE FROM processed_updates WHERE created_at < ?", (int(time.time()) - self.updates_ttl,)
+            )
+            pruned = cur.rowcount
+            await db.commit()
+        self.pruned_updates += pruned
+        return pruned
+
+    async def vacuum(self):
+        """Возвращает ОС свободные страницы по vacuum_pages за шаг (только при auto_vacuum=INCREMENTAL)"""
+        async with self.database.acquire() as db:
+            cur = await db.execute("PRAGMA auto_vacuum")
+            mode = (await cur.fetchone())[0]
+        if mode != AUTO_VACUUM_INCREMENTAL:
+            if not self._vacuum_warned:
+                self._vacuum_warned = True
+                log.warning(
+                    "auto_vacuum is not INCREMENTAL: free pages are reused but the file never shrinks. "
+                    "Convert once with the bot stopped: sqlite3 %s 'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;'",
+                    self.database.path
+                )
+            return 0
+        freed = 0
+        while True:
+            async with self.database.acquire() as db:
+                cur = await db.execute("PRAGMA freelist_count")
+                free = (await cur.fetchone())[0]
+                if not free:
+                    break
+                cur = await db.execute(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+                await cur.fetchall()  # прагма освобождает по странице на шаг
+                await db.commit()
+            freed += min(free, self.vacuum_pages)
+            await asyncio.sleep(self.pause)
+        self.vacuumed_pages += freed
+        return freed
+
+    async def run_once(self):
+        started = time.perf_counter()
+        expired = await self.expire_checks()
+        async with self.database.acquire() as db:
+            legacy = await legacy_activations_pending(db)
+        checks = promos = 0
+        if legacy:
+            log.info("archive skipped: activation backfill is still running")
+        else:
+            checks = await self.archive_checks()
+            promos = await self.archive_promos()
+        await self.prune_updates()
+        freed = await self.vacuum()
+        self.last_run_s = time.perf_counter() - started
+        if expired or checks or promos or freed:
+            log.info("archive: %s checks expired, %s checks and %s promo codes archived, %s pages freed in %.1fs",
+                     expired, checks, promos, freed, self.last_run_s)
+
+    async def loop(self, interval=3600):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("archive run failed")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {
+            "expired": self.expired,
+            "refunded": self.refunded,
+            "archived_checks": self.archived_checks,
+            "archived_promos": self.archived_promos,
+            "archived_activations": self.archived_activations,
+            "vacuumed_pages": self.vacuumed_pages,
+            "pruned_updates": self.pruned_updates,
+            "last_run_s": self.last_run_s,
+        }
@@ -0,0 +1,429 @@
+"""
+Оффлайн нагрузочный бенчмарк bot.py без настоящего Telegram.
+
+Поднимает локальный фейковый Bot API (getUpdates/sendMessage/editMessageText/
+getChatMember/answerCallbackQuery), направляет на него Bot и прогоняет
+сгенерированную нагрузку: массовые /start с рефералами, шторм claim_ по
+вирусным чекам, поток промокодов, нажатия profile/withdraw.
+
+    python bench.py                       # все сценарии, polling
+    python bench.py --scenario claims --updates 5000 --mode webhook
+
+Результаты (p50/p99 по типам апдейтов, updates/sec, время в БД, CPU и сборки мусора на апдейт)
+пишутся в bench_results/<время>.json и сравниваются с предыдущим прогоном.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web, ClientSession
+
+BENCH_TOKEN = "123456:BENCH-token"
+BOT_ID = 123456
+SCENARIOS = ("referrals", "claims", "promos", "callbacks")
+
+
+# === Fake Bot API ===
+class FakeBotAPI:
+    def __init__(self, api_latency=0.0, member_ratio=0.8):
+        self.api_latency = api_latency
+        self.member_ratio = member_ratio
+        self.calls = defaultdict(int)
+        self._updates = []
+        self._next_update_id = 1
+        self._new_updates = asyncio.Event()
+        self._message_id = 0
+
+    def push(self, update):
+        update["update_id"] = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append(update)
+        self._new_updates.set()
+
+    def _message(self, chat_id, text):
+        self._message_id += 1
+        return {
+            "message_id": self._message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+        }
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        if offset:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method != "getUpdates" and self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getMe":
+            result = {"id": BOT_ID, "is_bot": True, "first_name": "Bench", "username": "Maonik_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params.get("chat_id") or 0, params.get("text", ""))
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            status = "member" if (user_id % 100) < self.member_ratio * 100 else "left"
+            result = {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "u"}}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+# === Workload ===
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+
+def start_update(uid, param=""):
+    text = f"/start {param}" if param else "/start"
+    return {"message": {
+        "message_id": 1, "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"}, "from": _user(uid),
+    }}
+
+
+def callback_update(uid, data):
+    return {"callback_query": {
+        "id": f"{uid}-{random.getrandbits(32)}", "from": _user(uid), "chat_instance": "bench", "data": data,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "menu",
+            "chat": {"id": uid, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench"},
+        },
+    }}
+
+
+def update_kind(update):
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        return "cb_wd" if data.startswith("wd_") else f"cb_{data}"
+    text = (update.message.text or "") if update.message else ""
+    if text.startswith("/start claim_"):
+        return "claim"
+    if text.startswith("/start promo_"):
+        return "promo"
+    if text.startswith("/start "):
+        return "referral"
+    return "start" if text.startswith("/start") else "other"
+
+
+class Workload:
+    """Сид-данные и апдейты; id пользователей по диапазонам, чтобы сценарии не пересекались"""
+
+    REFERRERS = range(1_000, 1_050)
+    CREATORS = range(2_000, 2_010)
+    CALLBACK_USERS = range(3_000, 3_200)
+
+    def __init__(self, scenarios, updates, checks=5, activations=100, promos=5):
+        self.scenarios = scenarios
+        self.per_scenario = max(1, updates // len(scenarios))
+        self.checks = [f"bench{i:04d}" for i in range(checks)]
+        self.activations = activations
+        self.promos = [f"BENCH{i}" for i in range(promos)]
+
+    async def seed(self, database):
+        async with database.acquire() as db:
+            seeded = [*self.REFERRERS, *self.CREATORS, *self.CALLBACK_USERS]
+            await db.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+                [(uid, f"user{uid}", f"u{uid}") for uid in seeded]
+            )
+            await db.executemany(
+                "INSERT INTO ledger (user_id, amount, reason) VALUES (?, 1000, 'opening')",
+                [(uid,) for uid in seeded]
+            )
+            await db.executemany(
+                "INSERT INTO checks (check_id, creator_id, total_stars, activations_left, stars_per_activation) "
+                "VALUES (?, ?, ?, ?, 1)",
+                [(cid, self.CREATORS[i % len(self.CREATORS)], self.activations, self.activations)
+                 for i, cid in enumerate(self.checks)]
+            )
+            await db.executemany(
+                "INSERT INTO promo_codes (code, stars, activations_left) VALUES (?, 5, ?)",
+                [(code, self.activations) for code in self.promos]
+            )
+            await db.commit()
+
+    def updates(self):
+        out = []
+        uid = 100_000
+        for scenario in self.scenarios:
+            for i in range(self.per_scenario):
+                uid += 1
+                if scenario == "referrals":
+                    out.append(start_update(uid, str(random.choice(self.REFERRERS))))
+                elif scenario == "claims":
+                    # шторм: все чеки сразу, заявок больше, чем активаций
+                    out.append(start_update(uid, f"claim_{self.checks[i % len(self.checks)]}"))
+                elif scenario == "promos":
+                    out.append(start_update(uid, f"promo_{self.promos[i % len(self.promos)]}"))
+                elif scenario == "callbacks":
+                    cb_uid = self.CALLBACK_USERS[i % len(self.CALLBACK_USERS)]
+                    out.append(callback_update(cb_uid, random.choice(("profile", "profile", "back", "withdraw", "wd_15"))))
+        random.shuffle(out)
+        return out
+
+    async def verify(self, database):
+        """Чеки не активированы больше, чем позволено, начисления сходятся с активациями, балансы не ушли в минус"""
+        problems = []
+        async with database.acquire() as db:
+            for cid in self.checks:
+                cur = await db.execute("SELECT activations_left FROM checks WHERE check_id=?", (cid,))
+                left = (await cur.fetchone())[0]
+                cur = await db.execute("SELECT count(*) FROM check_activations WHERE check_id=?", (cid,))
+                used = (await cur.fetchone())[0]
+                if left < 0 or used + left != self.activations:
+                    problems.append(f"check {cid}: used={used} left={left}")
+                cur = await db.execute("SELECT coalesce(sum(amount), 0) FROM ledger WHERE reason='check' AND ref=?", (cid,))
+                credited = (await cur.fetchone())[0]
+                if credited != used:
+                    problems.append(f"check {cid}: used={used} credited={credited}")
+            cur = await db.execute("SELECT count(*) FROM (SELECT user_id FROM ledger GROUP BY user_id HAVING sum(amount) < 0)")
+            negative = (await cur.fetchone())[0]
+            if negative:
+                problems.append(f"{negative} negative balances")
+        return problems
+
+
+# === Measurement ===
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+class Recorder:
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.done = 0
+        self.finished = asyncio.Event()
+
+    def observe(self, update, elapsed, failed):
+        # вызывается из самого внешнего middleware (metrics), так что видит и отброшенные антифлудом апдейты
+        if failed:
+            self.errors += 1
+        self.latencies[update_kind(update)].append(elapsed)
+        self.done += 1
+        if self.done >= self.expected:
+            self.finished.set()
+
+
+async def feed_polling(bot_module, api, updates):
+    for update in updates:
+        api.push(update)
+    return asyncio.create_task(
+        bot_module.dp.start_polling(bot_module.bot, handle_signals=False, polling_timeout=1)
+    )
+
+
+async def feed_webhook(bot_module, updates, concurrency):
+    from aiohttp.test_utils import TestServer
+    from webhook import WebhookServer
+    server = WebhookServer(bot_module.dp, bot_module.bot, workers=bot_module.WEBHOOK_WORKERS,
+                           queue_size=bot_module.WEBHOOK_QUEUE_SIZE)
+    test_server = TestServer(server.make_app("/webhook"))
+    await test_server.start_server()
+    url = str(test_server.make_url("/webhook"))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def post(session, i, update):
+        async with sem:
+            update["update_id"] = i
+            async with session.post(url, json=update) as resp:
+                resp.raise_for_status()
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, i, u) for i, u in enumerate(updates, 1)))
+    return test_server
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="maonik-bench-")
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "DB_STATS_INTERVAL": "0",
+        "METRICS_PORT": "0",
+    })
+    api = FakeBotAPI(api_latency=args.api_latency / 1000)
+    base_url = await api.start()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+    from aiogram.client.telegram import TelegramAPIServer
+    from metrics import ApiTimingMiddleware
+    from render import RenderSession
+    bot_module.bot.session = RenderSession(bot_module.renderer, api=TelegramAPIServer.from_base(base_url))
+    bot_module.bot.session.middleware(ApiTimingMiddleware(bot_module.metrics))
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    workload = Workload(scenarios, args.updates, checks=args.checks, activations=args.activations)
+    updates = workload.updates()
+    recorder = Recorder(len(updates))
+    bot_module.metrics.listeners.append(recorder.observe)
+
+    await bot_module.start_services()
+    await workload.seed(bot_module.database)
+    db_before = bot_module.database.hold_total
+    queries_before = _db_queries(bot_module.metrics)
+    cpu_before = time.process_time()
+    gc_before = gc.get_stats()[0]["collections"]
+    started = time.perf_counter()
+
+    webhook_server = polling = None
+    if args.mode == "webhook":
+        webhook_server = await feed_webhook(bot_module, updates, args.concurrency)
+    else:
+        polling = await feed_polling(bot_module, api, updates)
+    try:
+        await asyncio.wait_for(recorder.finished.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        print(f"timeout: processed {recorder.done}/{len(updates)}", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_before
+    gc_runs = gc.get_stats()[0]["collections"] - gc_before
+    db_time = bot_module.database.hold_total - db_before
+    db_queries = _db_queries(bot_module.metrics) - queries_before
+
+    if polling:
+        await bot_module.dp.stop_polling()
+        await polling
+    if webhook_server:
+        await webhook_server.close()
+    problems = await workload.verify(bot_module.database)
+    await bot_module.stop_services()
+    await bot_module.bot.session.close()
+    await api.stop()
+
+    all_latencies = [v for values in recorder.latencies.values() for v in values]
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": _git_rev(),
+        "mode": args.mode,
+        "scenario": args.scenario,
+        "updates": len(updates),
+        "processed": recorder.done,
+        "errors": recorder.errors,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_sec": round(recorder.done / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(all_latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(all_latencies, 0.99) * 1000, 2),
+        "db_time_s": round(db_time, 3),
+        "db_queries_per_update": round(db_queries / max(1, recorder.done), 2),
+        "cpu_per_update_ms": round(cpu / max(1, recorder.done) * 1000, 3),
+        # сборка поколения 0 — на каждые gc.get_threshold()[0] новых объектов-контейнеров
+        "gc_gen0_per_1k_updates": round(gc_runs / max(1, recorder.done) * 1000, 1),
+        "by_kind": {
+            kind: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            }
+            for kind, values in sorted(recorder.latencies.items())
+        },
+        "api_calls": dict(api.calls),
+        "antiflood": bot_module.antiflood.stats(),
+        "consistency_problems": problems,
+    }
+
+
+def _db_queries(metrics):
+    return sum(series[-1] for series in metrics.db._series.values())
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def save_and_compare(result, results_dir):
+    os.makedirs(results_dir, exist_ok=True)
+    previous = sorted(
+        f for f in os.listdir(results_dir)
+        if f.endswith(".json")
+    )
+    path = os.path.join(results_dir, time.strftime("%Y%m%d-%H%M%S") + f"-{result['mode']}-{result['scenario']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"saved {path}")
+    same = [f for f in previous if f.endswith(f"-{result['mode']}-{result['scenario']}.json")]
+    if not same:
+        return
+    with open(os.path.join(results_dir, same[-1]), encoding="utf-8") as f:
+        prev = json.load(f)
+    print(f"vs {same[-1]} ({prev.get('commit')}):")
+    for key in ("updates_per_sec", "p50_ms", "p99_ms", "db_time_s", "db_queries_per_update", "cpu_per_update_ms",
+                "gc_gen0_per_1k_updates"):
+        old, new = prev.get(key), result.get(key)
+        if old:
+            print(f"  {key}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("all",) + SCENARIOS, default="all")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--checks", type=int, default=5)
+    parser.add_argument("--activations", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка фейкового API, мс")
+    parser.add_argument("--concurrency", type=int, default=64, help="параллельных POST в webhook-режиме")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--results-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results"))
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    result = asyncio.run(run(args))
+    print(json.dumps({k: v for k, v in result.items() if k != "by_kind"}, ensure_ascii=False, indent=2))
+    for kind, row in result["by_kind"].items():
+        print(f"  {kind:12} n={row['count']:<6} p50={row['p50_ms']}ms p99={row['p99_ms']}ms")
+    save_and_compare(result, args.results_dir)
+    if result["consistency_problems"] or result["processed"] < result["updates"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
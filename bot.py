@@ -1,25 +1,132 @@
 import asyncio
-import aiosqlite
+import io
+import logging
 import os
-import uuid
+import signal
+import time
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from aiogram.filters import CommandStart, Command
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (
+    Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ChatMemberUpdated, BufferedInputFile, Update,
+)
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.fsm.storage.memory import MemoryStorage
+
+from antiflood import AntiFlood
+from archive import Archiver
+from broadcast import Broadcaster
+from bulk import BulkCreator, CODE_RE, parse_promo_lines, generate_codes
+from counters import Counters, ALL_TIME
+from claims import ClaimEngine, CLAIM_NOT_FOUND, CLAIM_EXHAUSTED, CLAIM_DUPLICATE, CLAIM_EXPIRED
+from db import Database
+from fsm_storage import SQLiteStorage
+from ledger import Ledger
+from metrics import Metrics, ApiTimingMiddleware
+from migrations import migrate, legacy_activations_pending, backfill_activations
+from membership import MembershipCache, status_value
+from outbox import Outbox
+from render import Renderer, RenderSession
+from users import UserStore
+from webhook import WebhookServer, require_secret
+from withdrawals import Withdrawals
 
 # === CONFIG ===
 TOKEN = os.getenv("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")  # <- замените на свой токен или задайте BOT_TOKEN
+BOT_API_URL = os.getenv("BOT_API_URL", "")  # свой Bot API сервер (local bot-api); пусто — api.telegram.org
 CHANNEL = "@MAONIK_gift"
 ADMIN_IDS = {7955777831, 1483826275}  # замените на своих админов
 BOT_USERNAME = "Maonik_bot"  # используется в реферальных линках
-DB_PATH = "users.db"
+DB_PATH = os.getenv("DB_PATH", "users.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_STATS_INTERVAL = int(os.getenv("DB_STATS_INTERVAL", "300"))  # секунды, 0 — не логировать
+LEDGER_SNAPSHOT_INTERVAL = int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "300"))  # свёртка проводок в снимки балансов
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", "30"))  # кэш админского /stats, секунды
+# архив закончившихся чеков/промокодов, срок жизни чеков (0 — бессрочные), остаток истёкших — создателю
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", os.path.splitext(DB_PATH)[0] + "_archive.db")
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "200"))
+CHECK_TTL_DAYS = int(os.getenv("CHECK_TTL_DAYS", "0"))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))  # брошенные диалоги (создание чека и т.п.) истекают через сутки
+# исходящие сообщения: лимиты Telegram (~30 msg/s глобально, ~1 msg/s в чат) и окно склейки уведомлений
+SEND_RATE = float(os.getenv("SEND_RATE", "25"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+NOTIFY_WINDOW = float(os.getenv("NOTIFY_WINDOW", "3"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "20"))
+# массовое создание промокодов/чеков из админки: размер пачки на транзакцию и лимиты
+BULK_CHUNK = int(os.getenv("BULK_CHUNK", "500"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "100000"))
+BULK_MAX_FILE = 20 * 1024 * 1024  # больше Bot API боту не отдаёт
+WITHDRAW_PAGE = int(os.getenv("WITHDRAW_PAGE", "20"))  # заявок на странице очереди выводов
+
+# метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено) и порог медленного апдейта
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+SLOW_UPDATE_MS = int(os.getenv("SLOW_UPDATE_MS", "1000"))
+
+# режим работы: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес; пусто — set_webhook не вызывается (локальный тест)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен, если задан WEBHOOK_URL или WEBHOOK_HOST не loopback
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")  # за reverse proxy; 0.0.0.0 — только вместе с WEBHOOK_SECRET
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# > 1 — апдейты принимает супервизор и раздаёт процессам-воркерам по user_id (supervisor.py)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "100000"))  # готовые тексты профиля в памяти
 
 # === BOT & DISPATCHER ===
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+renderer = Renderer(profile_cache_size=PROFILE_CACHE_SIZE)
+if BOT_API_URL:
+    bot = Bot(token=TOKEN, session=RenderSession(renderer, api=TelegramAPIServer.from_base(BOT_API_URL)))
+else:
+    bot = Bot(token=TOKEN, session=RenderSession(renderer))
+database = Database(DB_PATH, size=DB_POOL_SIZE)
+fsm_storage = SQLiteStorage(database, ttl=FSM_STATE_TTL)
+dp = Dispatcher(storage=fsm_storage)
+counters = Counters(database, ttl=STATS_CACHE_TTL)
+ledger = Ledger(database, counters)
+claims = ClaimEngine(database, ledger, counters)
+user_store = UserStore(database, ledger, counters)
+membership = MembershipCache(database, bot, CHANNEL)
+outbox = Outbox(bot, global_rate=SEND_RATE, per_chat_rate=SEND_CHAT_RATE, coalesce_window=NOTIFY_WINDOW)
+broadcaster = Broadcaster(database, outbox, batch_size=BROADCAST_BATCH, workers=BROADCAST_WORKERS)
+bulk = BulkCreator(database, counters, chunk_size=BULK_CHUNK)
+withdrawals = Withdrawals(database, ledger)
+archiver = Archiver(database, ledger, counters, ARCHIVE_DB_PATH, batch_size=ARCHIVE_BATCH)
+
+# === Instrumentation ===
+# метки bot_update_seconds — только из этих списков (см. metrics.handler_label), при новом обработчике дописать
+METRIC_COMMANDS = ("/start", "/admin", "/withdrawals", "/stats", "/reconcile", "/broadcast")
+METRIC_CALLBACKS = (
+    "back", "profile", "earn", "create_check", "withdraw", "wd_",
+    "admin_create_promo", "admin_bulk", "admin_cancel", "admin_stats", "admin_broadcast", "bulk_promos", "bulk_checks",
+    "wdq_page_", "wdq_ok_", "wdq_no_", "bc_send", "bc_stop_",
+)
+metrics = Metrics(slow_threshold=SLOW_UPDATE_MS / 1000, commands=METRIC_COMMANDS, callbacks=METRIC_CALLBACKS)
+dp.update.outer_middleware(metrics.update_middleware)
+database.observer = metrics.observe_db
+bot.session.middleware(ApiTimingMiddleware(metrics))
+metrics.add_gauges("bot_db_pool", database.stats)
+metrics.add_gauges("bot_membership", membership.stats)
+metrics.add_gauges("bot_outbox", outbox.stats)
+metrics.add_gauges("bot_users", user_store.stats)
+metrics.add_gauges("bot_ledger", ledger.stats)
+metrics.add_gauges("bot_counters", counters.stats)
+metrics.add_gauges("bot_render", renderer.stats)
+metrics.add_gauges("bot_bulk", bulk.stats)
+metrics.add_gauges("bot_withdrawals", withdrawals.stats)
+metrics.add_gauges("bot_archive", archiver.stats)
+
+# антифлуд — сразу после метрик, до любых обработчиков и БД
+antiflood = AntiFlood(exempt=ADMIN_IDS)
+dp.update.outer_middleware(antiflood.middleware)
+metrics.add_gauges("bot_antiflood", antiflood.stats)
 
 # === FSM States ===
 class CreateCheck(StatesGroup):
@@ -31,127 +138,100 @@ class AdminCreatePromo(StatesGroup):
     waiting_stars = State()
     waiting_activations = State()
 
+class AdminBroadcast(StatesGroup):
+    waiting_text = State()
+
+class AdminBulk(StatesGroup):
+    waiting_promos = State()
+    waiting_checks = State()
+
 # === DB INIT ===
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            balance REAL DEFAULT 0,
-            ref_id INTEGER,
-            ref_bonus INTEGER DEFAULT 0,
-            invited_count INTEGER DEFAULT 0
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS checks (
-            check_id TEXT PRIMARY KEY,
-            creator_id INTEGER,
-            total_stars INTEGER,
-            activations_left INTEGER,
-            stars_per_activation INTEGER
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS check_activations (
-            check_id TEXT,
-            user_id INTEGER,
-            PRIMARY KEY (check_id, user_id)
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS promo_codes (
-            code TEXT PRIMARY KEY,
-            stars INTEGER,
-            activations_left INTEGER
-        )
-        """)
-        await db.commit()
+    # пул открывается один раз на весь процесс, схема — через миграции (PRAGMA user_version)
+    await database.open()
+    async with database.acquire() as db:
+        await migrate(db)
+        claims.legacy_activations = await legacy_activations_pending(db)
 
 # === Keyboards ===
-def menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Мой профиль", callback_data="profile")],
-        [InlineKeyboardButton(text="Заработать звезды", callback_data="earn")],
-        [InlineKeyboardButton(text="Удвоить звёзды", url="https://t.me/LUDKA_1stars")]
-    ])
-
-def back_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data="back")]
-    ])
-
-def profile_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Назад", callback_data="back")],
-        [InlineKeyboardButton(text="Вывести звёзды", callback_data="withdraw")],
-        [InlineKeyboardButton(text="Создать чек", callback_data="create_check")]
-    ])
-
-def withdraw_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[ 
-        [
-            InlineKeyboardButton(text="15⭐", callback_data="wd_15"),
-            InlineKeyboardButton(text="25⭐", callback_data="wd_25")
-        ],
-        [
-            InlineKeyboardButton(text="50⭐", callback_data="wd_50"),
-            InlineKeyboardButton(text="100⭐", callback_data="wd_100")
-        ],
-        [InlineKeyboardButton(text="Назад", callback_data="profile")]
-    ])
+# собираются один раз, неизменяемые и общие для всех ответов (см. render.py)
+GREETING = "Приветствуем вас в нашем боте!"
+
+MENU_KB = renderer.keyboard([
+    [("Мой профиль", "profile")],
+    [("Заработать звезды", "earn")],
+    [("Удвоить звёзды", "https://t.me/LUDKA_1stars")],
+])
+
+BACK_KB = renderer.keyboard([
+    [("Назад", "back")],
+])
+
+PROFILE_KB = renderer.keyboard([
+    [("Назад", "back")],
+    [("Вывести звёзды", "withdraw")],
+    [("Создать чек", "create_check")],
+])
+
+WITHDRAW_AMOUNTS = (15, 25, 50, 100)
+WITHDRAW_KB = renderer.keyboard([
+    [(f"{amount}⭐", f"wd_{amount}") for amount in WITHDRAW_AMOUNTS[:2]],
+    [(f"{amount}⭐", f"wd_{amount}") for amount in WITHDRAW_AMOUNTS[2:]],
+    [("Назад", "profile")],
+])
+
+SUBSCRIBE_KB = renderer.keyboard([
+    [("Подписаться", f"https://t.me/{CHANNEL.lstrip('@')}")],
+])
+
+ADMIN_KB = renderer.keyboard([
+    [("Создать промокод", "admin_create_promo")],
+    [("Массовое создание", "admin_bulk")],
+    [("Заявки на вывод", "wdq_page_0")],
+    [("Рассылка", "admin_broadcast")],
+    [("Статистика", "admin_stats")],
+    [("Отмена", "admin_cancel")],
+])
 
 # === Helpers ===
 async def is_subscribed(user_id):
-    """Проверяет подписку на CHANNEL"""
+    """Проверяет подписку на CHANNEL (кэш → зеркало channel_members → get_chat_member)"""
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
+        return await membership.is_member(user_id)
     except Exception:
         return False
 
+def markup_dump(markup):
+    # входящие модели несут приватный _bot, поэтому == с собранной клавиатурой всегда False
+    return markup.model_dump(exclude_none=True) if markup is not None else None
+
+async def edit_text_if_changed(call, text, reply_markup):
+    """edit_text, только если текст или клавиатура отличаются от текущих (иначе Telegram ответит 'message is not modified')"""
+    msg = call.message
+    if msg.text == text and markup_dump(msg.reply_markup) == markup_dump(reply_markup):
+        antiflood.skipped_renders += 1
+        return
+    try:
+        await msg.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        antiflood.skipped_renders += 1
+
+def check_expires_at(days):
+    return int(time.time()) + days * 86400 if days else None
+
 async def ensure_user_in_db(user, ref_id=None):
     """
     Вставляет пользователя в БД если нет.
-    Возвращает кортеж (created_new: bool)
+    Возвращает created_new: bool. Обновление имени/юзернейма пишется отложенно (см. UserStore).
     """
-    user_id = user.id
-    username = user.username or ""
-    first_name = user.first_name or ""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-        exists = await cur.fetchone()
-        if exists:
-            # Обновляем имя/юзернейм при необходимости
-            await db.execute("UPDATE users SET username=?, first_name=? WHERE user_id=?", (username, first_name, user_id))
-            await db.commit()
-            return False
-        # Insert new
-        if ref_id and ref_id != user_id:
-            # проверим что рефер существет
-            cur2 = await db.execute("SELECT user_id FROM users WHERE user_id=?", (ref_id,))
-            if await cur2.fetchone():
-                await db.execute(
-                    "INSERT INTO users (user_id, username, first_name, ref_id) VALUES (?, ?, ?, ?)",
-                    (user_id, username, first_name, ref_id)
-                )
-                # увеличить invited_count и дать небольшой бонус реферу (опционально)
-                await db.execute("UPDATE users SET invited_count = invited_count + 1 WHERE user_id=?", (ref_id,))
-                # например, дать 1 звезду реферу
-                await db.execute("UPDATE users SET balance = balance + 1 WHERE user_id=?", (ref_id,))
-                await db.commit()
-                return True
-        # без реферала
-        await db.execute("INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)", (user_id, username, first_name))
-        await db.commit()
-        return True
+    return await user_store.ensure(user, ref_id=ref_id)
 
 # === Handlers ===
 
 @dp.message(CommandStart())
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, command: CommandObject):
     """
     /start [param]
     Возможные param:
@@ -161,7 +241,7 @@ async def cmd_start(message: Message):
     """
     user = message.from_user
     user_id = user.id
-    args = message.get_args()  # aiogram 3: returns string after /start
+    args = command.args  # aiogram 3: Message.get_args() больше нет, аргумент приходит в CommandObject
     param = args.strip() if args else ""
 
     # handle referral by numeric id like /start 12345
@@ -179,115 +259,78 @@ async def cmd_start(message: Message):
     # === handle claim link: claim_<check_id>
     if param and param.startswith("claim_"):
         check_id = param[6:]
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT creator_id, activations_left, stars_per_activation FROM checks WHERE check_id=?", (check_id,))
-            row = await cur.fetchone()
-            if not row:
-                await message.answer("❌ Чек не найден или недействителен.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            creator_id, activations_left, stars_per_activation = row
-            if activations_left <= 0:
-                await message.answer("❌ У этого чека закончились активации.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            # prevent duplicate activation
-            cur2 = await db.execute("SELECT 1 FROM check_activations WHERE check_id=? AND user_id=?", (check_id, user_id))
-            if await cur2.fetchone():
-                await message.answer("❌ Вы уже активировали этот чек.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            # give stars, record activation, decrement activations_left
-            await db.execute("INSERT INTO check_activations (check_id, user_id) VALUES (?, ?)", (check_id, user_id))
-            await db.execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (stars_per_activation, user_id))
-            await db.execute("UPDATE checks SET activations_left = activations_left - 1 WHERE check_id=?", (check_id,))
-            await db.commit()
-            await message.answer(f"✅ Вы получили {stars_per_activation}⭐! Спасибо за активацию.")
-            # notify creator if possible
-            try:
-                await bot.send_message(creator_id, f"🎉 Ваш чек {check_id} активирован пользователем @{user.username or user.first_name or user_id}. Осталось активаций: {max(0, activations_left-1)}")
-            except Exception:
-                pass
-            await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-            return
+        # decrement, activation record and credit happen in one transaction
+        result = await claims.claim_check(check_id, user_id)
+        if result.status == CLAIM_NOT_FOUND:
+            await message.answer("❌ Чек не найден или недействителен.")
+        elif result.status == CLAIM_EXHAUSTED:
+            await message.answer("❌ У этого чека закончились активации.")
+        elif result.status == CLAIM_EXPIRED:
+            await message.answer("❌ Срок действия этого чека истёк.")
+        elif result.status == CLAIM_DUPLICATE:
+            await message.answer("❌ Вы уже активировали этот чек.")
+        else:
+            await message.answer(f"✅ Вы получили {result.stars}⭐! Спасибо за активацию.")
+            # уведомление создателю уходит через очередь и склеивается с соседними активациями
+            outbox.notify_activation(result.creator_id, check_id, user.username or user.first_name or user_id, result.activations_left)
+        await message.answer(GREETING, reply_markup=MENU_KB)
+        return
 
     # handle promo code param: promo_<code>
     if param and param.startswith("promo_"):
         code = param[6:]
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute("SELECT code, stars, activations_left FROM promo_codes WHERE code=?", (code,))
-            row = await cur.fetchone()
-            if not row:
-                await message.answer("❌ Промокод не найден или недействителен.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            _, stars, activations_left = row
-            if activations_left <= 0:
-                await message.answer("❌ У этого промокода закончились активации.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            # prevent duplicate use: use check_activations table with key promo_<code>
-            key = f"promo_{code}"
-            cur2 = await db.execute("SELECT 1 FROM check_activations WHERE check_id=? AND user_id=?", (key, user_id))
-            if await cur2.fetchone():
-                await message.answer("❌ Вы уже активировали этот промокод.")
-                await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-                return
-            # give stars and decrement
-            await db.execute("INSERT INTO check_activations (check_id, user_id) VALUES (?, ?)", (key, user_id))
-            await db.execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (stars, user_id))
-            await db.execute("UPDATE promo_codes SET activations_left = activations_left - 1 WHERE code=?", (code,))
-            await db.commit()
-            await message.answer(f"✅ Промокод применён — вы получили {stars}⭐!")
-            await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
-            return
+        result = await claims.claim_promo(code, user_id)
+        if result.status == CLAIM_NOT_FOUND:
+            await message.answer("❌ Промокод не найден или недействителен.")
+        elif result.status == CLAIM_EXHAUSTED:
+            await message.answer("❌ У этого промокода закончились активации.")
+        elif result.status == CLAIM_DUPLICATE:
+            await message.answer("❌ Вы уже активировали этот промокод.")
+        else:
+            await message.answer(f"✅ Промокод применён — вы получили {result.stars}⭐!")
+        await message.answer(GREETING, reply_markup=MENU_KB)
+        return
 
     # обычный старт — проверка подписки
     if not await is_subscribed(user_id):
         await message.answer(
             "‼️ Вы не подписаны на канал ‼️\nПожалуйста, подпишитесь, чтобы продолжить.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Подписаться", url=f"https://t.me/{CHANNEL.lstrip('@')}")]
-            ])
+            reply_markup=SUBSCRIBE_KB
         )
         return
 
-    await message.answer("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
+    await message.answer(GREETING, reply_markup=MENU_KB)
 
 @dp.callback_query(F.data == "back")
 async def back(call: CallbackQuery):
-    await call.message.edit_text("Приветствуем вас в нашем боте!", reply_markup=menu_kb())
+    await edit_text_if_changed(call, GREETING, MENU_KB)
     await call.answer()
 
 @dp.callback_query(F.data == "profile")
 async def profile(call: CallbackQuery):
     user_id = call.from_user.id
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT first_name, username, balance, invited_count FROM users WHERE user_id=?", (user_id,))
+    async with database.acquire() as db:
+        cur = await db.execute("SELECT first_name, username, invited_count FROM users WHERE user_id=?", (user_id,))
         row = await cur.fetchone()
-        if not row:
-            # should not happen, but ensure
-            await ensure_user_in_db(call.from_user)
-            first_name = call.from_user.first_name or ""
-            username = call.from_user.username or ""
-            balance = 0.0
-            invited = 0
-        else:
-            first_name, username, balance, invited = row
-
-    text = (
-        f"👤 Профиль: {first_name} (@{username})\n"
-        f"⭐ Баланс: {balance}\n"
-        f"🤝 Пригласил: {invited}"
-    )
-    await call.message.edit_text(text, reply_markup=profile_kb())
+        balance = await ledger.balance(user_id, db)
+    if not row:
+        # should not happen, but ensure (соединение уже возвращено в пул)
+        await ensure_user_in_db(call.from_user)
+        first_name = call.from_user.first_name or ""
+        username = call.from_user.username or ""
+        invited = 0
+    else:
+        first_name, username, invited = row
+
+    text = renderer.profile(user_id, first_name, username, balance, invited)
+    await edit_text_if_changed(call, text, PROFILE_KB)
     await call.answer()
 
 @dp.callback_query(F.data == "earn")
 async def earn(call: CallbackQuery):
     # Здесь можно добавить реальную логику — например задания/проверки
     text = "Здесь можно заработать звезды — пока что поделитесь ссылкой на бота или используйте промокоды."
-    await call.message.edit_text(text, reply_markup=back_kb())
+    await edit_text_if_changed(call, text, BACK_KB)
     await call.answer()
 
 @dp.callback_query(F.data == "create_check")
@@ -311,7 +354,7 @@ async def create_check_amount(message: Message, state: FSMContext):
     await state.set_state(CreateCheck.waiting_activations)
 
 @dp.message(CreateCheck.waiting_activations)
-async def create_check_activations(message: Message, state: FSMContext):
+async def create_check_activations(message: Message, state: FSMContext, event_update: Update):
     txt = message.text.strip()
     if not txt.isdigit():
         await message.answer("Введите целое число для активаций.")
@@ -330,32 +373,23 @@ async def create_check_activations(message: Message, state: FSMContext):
         stars_per_activation = 1
         activations = amount
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        # check balance
-        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        balance = row[0] if row else 0
-        if balance < amount:
-            await message.answer("❌ У вас недостаточно звёзд для создания чека.")
-            await state.clear()
-            return
-        # создаём чек
-        check_id = uuid.uuid4().hex[:12]
-        await db.execute(
-            "INSERT INTO checks (check_id, creator_id, total_stars, activations_left, stars_per_activation) VALUES (?, ?, ?, ?, ?)",
-            (check_id, user_id, amount, activations, stars_per_activation)
-        )
-        # списываем со счета творця
-        await db.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (amount, user_id))
-        await db.commit()
+    # повторная доставка после падения воркера вернёт уже созданный и оплаченный чек
+    check_id = await claims.create_check(user_id, amount, activations, stars_per_activation,
+                                         check_expires_at(CHECK_TTL_DAYS), update_id=event_update.update_id)
+    if check_id is None:
+        await message.answer("❌ У вас недостаточно звёзд для создания чека.")
+        await state.clear()
+        return
 
     # формируем сообщение для создателя
     claim_link = f"https://t.me/{BOT_USERNAME}?start=claim_{check_id}"
+    expiry = f"⏳ Действует {CHECK_TTL_DAYS} дн., неиспользованные звёзды вернутся на баланс\n\n" if CHECK_TTL_DAYS else ""
     text = (
         "💳 Чек создан!\n"
         f"⭐ Звезд: {amount}\n\n"
         f"🔁 Доступных активаций: {activations}\n\n"
         f"🎁 За каждую активацию — {stars_per_activation} ⭐\n\n"
+        f"{expiry}"
         "👇 Нажми кнопку ниже, чтобы поделиться чеком и чтобы другие забрали свои звёзды!"
     )
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -365,30 +399,30 @@ async def create_check_activations(message: Message, state: FSMContext):
     await message.answer(text, reply_markup=kb)
     await state.clear()
 
-# === Withdraw callbacks (simple implementation) ===
+# === Withdraw ===
+@dp.callback_query(F.data == "withdraw")
+async def withdraw(call: CallbackQuery):
+    await edit_text_if_changed(call, "Сколько звёзд вывести?", WITHDRAW_KB)
+    await call.answer()
+
 @dp.callback_query(F.data.startswith("wd_"))
-async def withdraw_amount(call: CallbackQuery):
+async def withdraw_amount(call: CallbackQuery, event_update: Update):
     user_id = call.from_user.id
     pair = call.data.split("_")
     if len(pair) != 2:
         await call.answer()
         return
-    try:
-        amount = int(pair[1])
-    except Exception:
+    # callback_data приходит от клиента — принимаем только суммы с клавиатуры (иначе wd_-5 начислит звёзды)
+    amount = int(pair[1]) if pair[1].isdigit() else None
+    if amount not in WITHDRAW_AMOUNTS:
         await call.answer()
         return
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        balance = row[0] if row else 0
-        if balance < amount:
-            await call.answer("У вас недостаточно звёзд.", show_alert=True)
-            return
-        # вычитаем и регистрируем (платежная логика не реализована)
-        await db.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (amount, user_id))
-        await db.commit()
-    await call.message.answer(f"✅ Запрошен вывод {amount}⭐. Администратор свяжется с вами для подтверждения (реализуйте логику выплат).")
+    # проверка баланса и списание — в одной транзакции с созданием заявки
+    request_id = await withdrawals.request(user_id, amount, event_update.update_id)
+    if request_id is None:
+        await call.answer("У вас недостаточно звёзд.", show_alert=True)
+        return
+    await call.message.answer(f"✅ Заявка #{request_id} на вывод {amount}⭐ создана. Администратор свяжется с вами после проверки.")
     await call.answer()
 
 # === Admin panel ===
@@ -398,11 +432,7 @@ async def admin_panel(message: Message, state: FSMContext):
     if user_id not in ADMIN_IDS:
         # игнорируем (не отвечаем)
         return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Создать промокод", callback_data="admin_create_promo")],
-        [InlineKeyboardButton(text="Отмена", callback_data="admin_cancel")]
-    ])
-    await message.answer("Админ-панель:", reply_markup=kb)
+    await message.answer("Админ-панель:", reply_markup=ADMIN_KB)
 
 @dp.callback_query(F.data == "admin_create_promo")
 async def admin_create_promo_start(call: CallbackQuery, state: FSMContext):
@@ -450,44 +480,540 @@ async def admin_create_promo_activations(message: Message, state: FSMContext):
     data = await state.get_data()
     code = data.get("code")
     stars = data.get("stars")
-    # insert promo code
-    async with aiosqlite.connect(DB_PATH) as db:
+    # insert promo code; ответ и state.clear() — уже после возврата соединения в пул
+    async with database.acquire() as db:
         cur = await db.execute("SELECT 1 FROM promo_codes WHERE code=?", (code,))
-        if await cur.fetchone():
-            await message.answer("❌ Такой промокод уже существует. Операция отменена.")
-            await state.clear()
-            return
-        await db.execute("INSERT INTO promo_codes (code, stars, activations_left) VALUES (?, ?, ?)", (code, stars, activations))
-        await db.commit()
+        exists = await cur.fetchone() is not None
+        if not exists:
+            await db.execute("INSERT INTO promo_codes (code, stars, activations_left) VALUES (?, ?, ?)", (code, stars, activations))
+            await counters.bump(db, "promos_active", day=ALL_TIME)
+            await db.commit()
+    if exists:
+        await message.answer("❌ Такой промокод уже существует. Операция отменена.")
+        await state.clear()
+        return
 
     link = f"https://t.me/{BOT_USERNAME}?start=promo_{code}"
     await message.answer(f"✅ Промокод создан:\nКод: {code}\nЗвёзд: {stars}\nАктиваций: {activations}\n\nСсылка: {link}")
     await state.clear()
 
+# === Admin bulk creation ===
+@dp.callback_query(F.data == "admin_bulk")
+async def admin_bulk_menu(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Промокоды", callback_data="bulk_promos")],
+        [InlineKeyboardButton(text="Чеки", callback_data="bulk_checks")],
+        [InlineKeyboardButton(text="Отмена", callback_data="admin_cancel")]
+    ])
+    await call.message.answer("Что создаём пачкой?", reply_markup=kb)
+    await call.answer()
+
+@dp.callback_query(F.data == "bulk_promos")
+async def admin_bulk_promos_start(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    await call.message.answer(
+        "Отправьте CSV/TXT-файл: строка — «код,звёзды,активации» (или только «код», "
+        "тогда звёзды и активации укажите в подписи к файлу: «50 100»).\n\n"
+        "Или сгенерируйте коды: «количество префикс звёзды активации», например: 1000 NY25 10 1"
+    )
+    await state.set_state(AdminBulk.waiting_promos)
+    await call.answer()
+
+@dp.callback_query(F.data == "bulk_checks")
+async def admin_bulk_checks_start(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    await call.message.answer(
+        "Чеки: «количество звёзд_за_активацию активаций [дней]», например: 500 5 1 7\n"
+        "Через указанное число дней неиспользованные чеки закроются. Чеки создаются без списания с баланса, "
+        "поэтому остаток никому не возвращается."
+    )
+    await state.set_state(AdminBulk.waiting_checks)
+    await call.answer()
+
+def parse_numbers(parts):
+    """Целые положительные числа или None, если хоть одно не подходит"""
+    if not all(p.isdigit() and int(p) > 0 for p in parts):
+        return None
+    return [int(p) for p in parts]
+
+async def send_bulk_result(message: Message, start_prefix, result, errors=()):
+    rows = ["code,stars,activations,link"]
+    rows.extend(
+        f"{code},{stars},{activations},https://t.me/{BOT_USERNAME}?start={start_prefix}{code}"
+        for code, stars, activations in result["created"]
+    )
+    text = (
+        f"✅ Создано: {len(result['created'])}\n"
+        f"Уже существовали: {result['duplicates']}\n"
+        f"Отбраковано строк: {len(errors)}\n"
+        f"Время: {result['elapsed']:.1f} с ({result['rate']:.0f}/с)"
+    )
+    if errors:
+        text += "\n\n" + "\n".join(f"строка {lineno}: {reason}" for lineno, reason in errors[:10])
+    if result["created"]:
+        document = BufferedInputFile("\n".join(rows).encode(), filename=f"{start_prefix}{int(time.time())}.csv")
+        await message.answer_document(document, caption=text[:1024])
+    else:
+        await message.answer(text)
+
+@dp.message(AdminBulk.waiting_promos, F.document)
+async def admin_bulk_promos_file(message: Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE:
+        await message.answer("Файл больше 20 МБ — разбейте его на части.")
+        return
+    defaults = parse_numbers((message.caption or "").split()) or []
+    if len(defaults) != 2:
+        defaults = [None, None]
+    await state.clear()
+    buf = await bot.download(document)
+    errors = []
+    lines = io.TextIOWrapper(buf, encoding="utf-8-sig", errors="replace")
+    rows = parse_promo_lines(lines, errors, stars=defaults[0], activations=defaults[1], max_rows=BULK_MAX_ROWS)
+    result = await bulk.create_promos(rows)
+    await send_bulk_result(message, "promo_", result, errors)
+
+@dp.message(AdminBulk.waiting_promos)
+async def admin_bulk_promos_generate(message: Message, state: FSMContext):
+    parts = (message.text or "").split()
+    numbers = parse_numbers(parts[:1] + parts[2:]) if len(parts) == 4 else None
+    if not numbers:
+        await message.answer("Формат: «количество префикс звёзды активации», например: 1000 NY25 10 1")
+        return
+    count, stars, activations = numbers
+    prefix = parts[1]
+    if count > BULK_MAX_ROWS:
+        await message.answer(f"Не больше {BULK_MAX_ROWS} кодов за раз.")
+        return
+    if len(prefix) > 49 or not CODE_RE.match(prefix):
+        await message.answer("Префикс: латиница, цифры, _ и -, до 49 символов.")
+        return
+    await state.clear()
+    result = await bulk.create_promos(generate_codes(prefix, count, stars, activations))
+    await send_bulk_result(message, "promo_", result)
+
+@dp.message(AdminBulk.waiting_checks)
+async def admin_bulk_checks(message: Message, state: FSMContext):
+    numbers = parse_numbers((message.text or "").split())
+    if not numbers or len(numbers) not in (3, 4):
+        await message.answer("Формат: «количество звёзд_за_активацию активаций [дней]», например: 500 5 1 7")
+        return
+    count, stars, activations, days = (numbers + [CHECK_TTL_DAYS])[:4]
+    if count > BULK_MAX_ROWS:
+        await message.answer(f"Не больше {BULK_MAX_ROWS} чеков за раз.")
+        return
+    await state.clear()
+    result = await bulk.create_checks(message.from_user.id, count, stars, activations, check_expires_at(days))
+    await send_bulk_result(message, "claim_", result)
+
 @dp.callback_query(F.data == "admin_cancel")
 async def admin_cancel(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         await call.answer()
         return
     await state.clear()
-    await call.message.edit_text("Отменено.", reply_markup=menu_kb())
+    await call.message.edit_text("Отменено.", reply_markup=MENU_KB)
+    await call.answer()
+
+# === Admin withdrawals queue ===
+async def withdrawals_page(after_id):
+    rows, count, total = await withdrawals.pending_page(after_id, WITHDRAW_PAGE)
+    if not rows:
+        return f"Заявок на вывод нет (ожидают: {count}).", None
+    last_id = rows[-1][0]
+    lines = [f"💸 Ожидают вывода: {count} заявок на {total}⭐\n"]
+    lines.extend(
+        f"#{wd_id} · {user_id} · {amount}⭐ · {time.strftime('%d.%m %H:%M', time.localtime(created_at))}"
+        for wd_id, user_id, amount, created_at in rows
+    )
+    buttons = [[
+        InlineKeyboardButton(text=f"✅ Одобрить {len(rows)}", callback_data=f"wdq_ok_{after_id}_{last_id}"),
+        InlineKeyboardButton(text=f"❌ Отклонить {len(rows)}", callback_data=f"wdq_no_{after_id}_{last_id}"),
+    ]]
+    if count > len(rows):
+        buttons.append([InlineKeyboardButton(text="Дальше ▶", callback_data=f"wdq_page_{last_id}")])
+    buttons.append([InlineKeyboardButton(text="В начало", callback_data="wdq_page_0")])
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@dp.message(Command(commands=["withdrawals"]))
+async def admin_withdrawals_cmd(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    text, kb = await withdrawals_page(0)
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("wdq_page_"))
+async def admin_withdrawals_page(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    try:
+        after_id = int(call.data[9:])
+    except ValueError:
+        await call.answer()
+        return
+    text, kb = await withdrawals_page(after_id)
+    await edit_text_if_changed(call, text, kb)
+    await call.answer()
+
+@dp.callback_query(F.data.startswith("wdq_ok_") | F.data.startswith("wdq_no_"))
+async def admin_withdrawals_process(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    try:
+        after_id, last_id = map(int, call.data[7:].split("_"))
+    except ValueError:
+        await call.answer()
+        return
+    approve = call.data.startswith("wdq_ok_")
+    rows, elapsed = await withdrawals.process_range(after_id, last_id, approve, call.from_user.id)
+    for wd_id, user_id, amount in rows:
+        if approve:
+            outbox.send(user_id, f"✅ Заявка #{wd_id} на вывод {amount}⭐ одобрена.")
+        else:
+            outbox.send(user_id, f"❌ Заявка #{wd_id} на вывод {amount}⭐ отклонена, звёзды возвращены на баланс.")
+    text, kb = await withdrawals_page(after_id)
+    await edit_text_if_changed(call, text, kb)
+    await call.answer(f"{'Одобрено' if approve else 'Отклонено'}: {len(rows)} за {elapsed * 1000:.0f} мс")
+
+# === Admin stats ===
+STATS_LEDGER_ROWS = [
+    ("ledger:check", "активации чеков"),
+    ("ledger:promo", "промокоды"),
+    ("ledger:referral", "реферальные бонусы"),
+    ("ledger:check_create", "вложено в чеки"),
+    ("ledger:check_expired", "возвраты истёкших чеков"),
+    ("ledger:withdraw", "выводы"),
+    ("ledger:withdraw_refund", "возвраты выводов"),
+]
+
+def stats_text(data):
+    counters_ = data["counters"]
+    get = lambda key: counters_.get(key, (0, 0, 0, 0))  # (count, total, count_today, total_today)
+    users, _, users_today, _ = get("users")
+    issued_today = get("ledger:promo")[3] + get("ledger:referral")[3] + get("ledger:check")[3]
+    circulating = sum(total for key, (_, total, _, _) in counters_.items() if key.startswith("ledger:"))
+    pending_count, pending_sum = data["pending_withdrawals"]
+    lines = [
+        "📊 Статистика",
+        f"👥 Пользователи: {users} (+{users_today} сегодня, по рефке: {get('ledger:referral')[2]})",
+        f"🎫 Активных чеков: {get('checks_active')[0]}, промокодов: {get('promos_active')[0]}",
+        f"⭐ Начислено сегодня: {issued_today}, на балансах: {circulating}",
+        f"💸 Ожидают вывода: {pending_count} заявок на {pending_sum}⭐",
+        "",
+        "Сегодня / всего:",
+    ]
+    for key, title in STATS_LEDGER_ROWS:
+        count, total, count_today, total_today = get(key)
+        lines.append(f"• {title}: {abs(total_today)}⭐ ({count_today}) / {abs(total)}⭐ ({count})")
+    lines += ["", "🏆 Топ рефереров:"]
+    for place, (user_id, username, first_name, invited) in enumerate(data["top"], 1):
+        name = f"@{username}" if username else (first_name or str(user_id))
+        lines.append(f"{place}. {name} — {invited}")
+    if not data["top"]:
+        lines.append("пока никого")
+    lines.append(f"\nОбновлено в {time.strftime('%H:%M:%S', time.localtime(data['built_at']))}")
+    return "\n".join(lines)
+
+@dp.message(Command(commands=["stats"]))
+async def admin_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer(stats_text(await counters.dashboard()))
+
+@dp.callback_query(F.data == "admin_stats")
+async def admin_stats_cb(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    await call.message.answer(stats_text(await counters.dashboard()))
+    await call.answer()
+
+# === Admin ledger reconciliation ===
+@dp.message(Command(commands=["reconcile"]))
+async def admin_reconcile(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer("🔎 Сверяю журнал проводок со снимками балансов...")
+    await ledger.snapshot()
+    r = await ledger.reconcile()
+    text = (
+        f"{'✅' if not r['mismatches'] and not r['negative'] else '⚠️'} Сверка журнала\n"
+        f"Проводок: {r['entries']}, сумма: {r['total']}⭐\n"
+        f"Проверено снимков: {r['checked']}\n"
+        f"Расхождений: {len(r['mismatches'])}, отрицательных балансов: {len(r['negative'])}\n"
+        f"Время: {r['elapsed']:.1f} с"
+    )
+    details = [f"{uid}: снимок {snap}, по журналу {folded}" for uid, snap, folded in r["mismatches"][:10]]
+    details += [f"{uid}: баланс {balance}" for uid, balance in r["negative"][:10]]
+    if details:
+        text += "\n\n" + "\n".join(details)
+    await message.answer(text)
+
+# === Admin broadcast ===
+def broadcast_text(p):
+    done = p["sent"] + p["failed"] + p["blocked"]
+    eta = f"{int(p['eta'] // 60)} мин {int(p['eta'] % 60)} с" if p["eta"] is not None else "—"
+    title = {"running": "идёт", "done": "завершена", "cancelled": "остановлена"}[p["status"]]
+    return (
+        f"📣 Рассылка #{p['id']} {title}\n"
+        f"Обработано: {done}/{p['total']}\n"
+        f"✅ Доставлено: {p['sent']}  🚫 Заблокировали: {p['blocked']}  ⚠️ Ошибки: {p['failed']}\n"
+        f"Скорость: {p['rate']:.1f} msg/s, осталось: {eta}"
+    )
+
+async def report_broadcast(p):
+    if not p["status_chat_id"]:
+        return
+    kb = None
+    if p["status"] == "running":
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Остановить", callback_data=f"bc_stop_{p['id']}")]
+        ])
+    try:
+        await bot.edit_message_text(broadcast_text(p), chat_id=p["status_chat_id"], message_id=p["status_message_id"], reply_markup=kb)
+    except TelegramBadRequest:
+        pass  # message is not modified
+
+async def start_broadcast_input(message: Message, state: FSMContext):
+    await message.answer("Отправьте текст рассылки одним сообщением:")
+    await state.set_state(AdminBroadcast.waiting_text)
+
+@dp.message(Command(commands=["broadcast"]))
+async def admin_broadcast_cmd(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await start_broadcast_input(message, state)
+
+@dp.callback_query(F.data == "admin_broadcast")
+async def admin_broadcast_start(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    await start_broadcast_input(call.message, state)
     await call.answer()
 
+@dp.message(AdminBroadcast.waiting_text)
+async def admin_broadcast_text(message: Message, state: FSMContext):
+    text = (message.text or "").strip()
+    if not text:
+        await message.answer("Текст не может быть пустым. Попробуйте ещё раз.")
+        return
+    await state.update_data(text=text)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Отправить всем", callback_data="bc_send")],
+        [InlineKeyboardButton(text="Отмена", callback_data="admin_cancel")]
+    ])
+    await message.answer(f"Предпросмотр рассылки:\n\n{text}", reply_markup=kb)
+
+@dp.callback_query(F.data == "bc_send")
+async def admin_broadcast_send(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    data = await state.get_data()
+    text = data.get("text")
+    await state.clear()
+    if not text:
+        await call.answer("Рассылка уже запущена или отменена.", show_alert=True)
+        return
+    status = await call.message.answer("📣 Рассылка запускается...")
+    broadcast_id, total = await broadcaster.create(text, call.from_user.id, status.chat.id, status.message_id)
+    broadcaster.start(broadcast_id, report_broadcast)
+    await call.answer(f"Рассылка #{broadcast_id}: {total} получателей")
+
+@dp.callback_query(F.data.startswith("bc_stop_"))
+async def admin_broadcast_stop(call: CallbackQuery):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer()
+        return
+    try:
+        broadcaster.cancel(int(call.data[8:]))
+    except ValueError:
+        pass
+    await call.answer("Останавливаю после текущей пачки...")
+
+@dp.my_chat_member(F.chat.type == "private")
+async def on_bot_blocked(event: ChatMemberUpdated):
+    # пользователь заблокировал бота (kicked) или разблокировал его (member)
+    status = status_value(event.new_chat_member.status)
+    if status in ("kicked", "member"):
+        await broadcaster.set_blocked(event.from_user.id, status == "kicked")
+
+# === Channel membership mirror ===
+@dp.chat_member(F.chat.username == CHANNEL.lstrip("@"))
+async def on_channel_member(event: ChatMemberUpdated):
+    # бот должен быть админом канала, иначе эти апдейты не приходят
+    member = event.new_chat_member
+    await membership.store(member.user.id, status_value(member.status))
+
 # === Fallback for text messages ===
 @dp.message()
 async def fallback(message: Message):
-    await message.answer("Используйте меню — нажмите /start, чтобы открыть меню.", reply_markup=menu_kb())
+    await message.answer("Используйте меню — нажмите /start, чтобы открыть меню.", reply_markup=MENU_KB)
 
 # === Main ===
-async def main():
-    await init_db()
-    # drop webhook if any and start polling
+background_tasks = []
+background_runners = []
+
+def log_stats():
+    logging.info("db pool: %s", database.stats())
+    logging.info("membership: %s", membership.stats())
+    logging.info("outbox: %s", outbox.stats())
+    logging.info("users: %s", user_store.stats())
+    logging.info("ledger: %s", ledger.stats())
+    logging.info("counters: %s", counters.stats())
+    logging.info("render: %s", renderer.stats())
+    logging.info("antiflood: %s", antiflood.stats())
+    logging.info("bulk: %s", bulk.stats())
+    logging.info("withdrawals: %s", withdrawals.stats())
+    logging.info("archive: %s", archiver.stats())
+
+async def report_db_stats():
+    """Периодически пишет в лог время ожидания пула — по нему подбирается DB_POOL_SIZE"""
+    while True:
+        await asyncio.sleep(DB_STATS_INTERVAL)
+        log_stats()
+
+async def run_webhook():
+    require_secret(WEBHOOK_HOST, WEBHOOK_SECRET, public=bool(WEBHOOK_URL))
+    server = WebhookServer(dp, bot, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+        )
+    print(f"Bot started (webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})...")
+    try:
+        await server.run(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    finally:
+        logging.info("webhook: %s", server.stats())
+        await bot.session.close()
+
+async def run_activation_backfill():
+    def drained():
+        claims.legacy_activations = False
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        await backfill_activations(database, on_drained=drained)
+    except asyncio.CancelledError:
+        raise
     except Exception:
+        logging.exception("activation backfill failed, will retry on next start")
+
+async def start_services(primary=True):
+    """
+    БД, фоновые задачи и очереди — общее для polling, webhook, воркеров супервизора и бенчмарка.
+    primary=False — воркер супервизора кроме первого: общие для всей базы фоновые задачи
+    (перепроверка подписок, чистка FSM, снимки балансов, архивация, возобновление рассылок,
+    перенос активаций) не запускаются.
+    """
+    await init_db()
+    if DB_STATS_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(report_db_stats()))
+    background_tasks.append(asyncio.create_task(user_store.flush_loop()))
+    outbox.start()
+    if primary:
+        background_tasks.append(asyncio.create_task(membership.reverify_loop()))
+        background_tasks.append(asyncio.create_task(fsm_storage.cleanup_loop()))
+        await counters.rebuild()
+        background_tasks.append(asyncio.create_task(ledger.snapshot_loop(LEDGER_SNAPSHOT_INTERVAL)))
+        background_tasks.append(asyncio.create_task(archiver.loop(ARCHIVE_INTERVAL)))
+        await broadcaster.resume_all(report_broadcast)
+        if claims.legacy_activations:
+            background_tasks.append(asyncio.create_task(run_activation_backfill()))
+    if METRICS_PORT:
+        background_runners.append(await metrics.serve(METRICS_HOST, METRICS_PORT))
+
+async def stop_services():
+    await broadcaster.stop()
+    await outbox.stop()
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    for runner in background_runners:
+        await runner.cleanup()
+    background_runners.clear()
+    await user_store.flush()
+    log_stats()
+    await archiver.close()
+    await database.close()
+
+async def run_supervisor():
+    from supervisor import Supervisor, poll_updates, serve_webhook
+
+    if BOT_MODE == "webhook":
+        # до запуска воркеров — иначе ошибка конфигурации оставит их висеть
+        require_secret(WEBHOOK_HOST, WEBHOOK_SECRET, public=bool(WEBHOOK_URL))
+    supervisor = Supervisor(BOT_WORKERS)
+    supervisor.start()
+    monitor = asyncio.create_task(supervisor.monitor())
+    runner = None
+    if METRICS_PORT:
+        supervisor_metrics = Metrics()
+        supervisor_metrics.add_gauges("supervisor", supervisor.stats)
+        runner = await supervisor_metrics.serve(METRICS_HOST, METRICS_PORT)
+    if BOT_MODE == "webhook":
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=True,
+            )
+        ingest = asyncio.create_task(serve_webhook(supervisor, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET))
+    else:
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+        except Exception:
+            pass
+        ingest = asyncio.create_task(poll_updates(bot, supervisor, dp.resolve_used_update_types()))
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, ingest.cancel)
+    print(f"Bot started ({BOT_WORKERS} worker processes, {BOT_MODE})...")
+    try:
+        await ingest
+    except asyncio.CancelledError:
         pass
-    print("Bot started...")
-    await dp.start_polling(bot)
+    finally:
+        # приём остановлен — ждём, пока воркеры дообработают принятое
+        monitor.cancel()
+        await supervisor.stop()
+        logging.info("supervisor: %s", supervisor.stats())
+        if runner:
+            await runner.cleanup()
+        await bot.session.close()
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    if BOT_WORKERS > 1:
+        # БД и фоновые задачи живут в воркерах, супервизор только принимает апдейты
+        await run_supervisor()
+        return
+    await start_services()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # drop webhook if any and start polling
+            try:
+                await bot.delete_webhook(drop_pending_updates=True)
+            except Exception:
+                pass
+            print("Bot started...")
+            await dp.start_polling(bot)
+    finally:
+        await stop_services()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramForbiddenError
+
+log = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """
+    Рассылка по таблице users: keyset-пагинация пачками, пул воркеров поверх
+    глобального лимита Outbox, чекпоинт в таблице broadcasts после каждой пачки —
+    после падения/рестарта рассылка продолжается с last_user_id.
+    Заблокировавшие бота попадают в blocked_users и пропускаются дальше;
+    при разблокировке (my_chat_member -> member) строка удаляется через set_blocked.
+    """
+
+    def __init__(self, database, outbox, batch_size=200, workers=20, report_interval=5):
+        self.database = database
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.workers = workers
+        self.report_interval = report_interval
+        self._running = {}  # broadcast_id -> Task
+        self._cancelled = set()
+
+    async def create(self, text, admin_id, status_chat_id=None, status_message_id=None):
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT count(*) FROM users WHERE user_id NOT IN (SELECT user_id FROM blocked_users)"
+            )
+            total = (await cur.fetchone())[0]
+            cur = await db.execute(
+                "INSERT INTO broadcasts (text, created_by, created_at, status, last_user_id, total, "
+                "status_chat_id, status_message_id) VALUES (?, ?, ?, 'running', 0, ?, ?, ?)",
+                (text, admin_id, int(time.time()), total, status_chat_id, status_message_id)
+            )
+            broadcast_id = cur.lastrowid
+            await db.commit()
+        return broadcast_id, total
+
+    def start(self, broadcast_id, report=None):
+        if broadcast_id not in self._running:
+            task = asyncio.create_task(self._run(broadcast_id, report))
+            self._running[broadcast_id] = task
+            task.add_done_callback(lambda _: self._running.pop(broadcast_id, None))
+
+    async def resume_all(self, report=None):
+        """Перезапускает рассылки, прерванные рестартом"""
+        async with self.database.acquire() as db:
+            cur = await db.execute("SELECT id FROM broadcasts WHERE status='running'")
+            ids = [r[0] for r in await cur.fetchall()]
+        for broadcast_id in ids:
+            log.info("resuming broadcast %s", broadcast_id)
+            self.start(broadcast_id, report)
+        return ids
+
+    async def stop(self):
+        # рестарт: статус остаётся running, resume_all() продолжит с чекпоинта
+        tasks = list(self._running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def cancel(self, broadcast_id):
+        self._cancelled.add(broadcast_id)
+
+    async def _load(self, broadcast_id):
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT text, last_user_id, sent, failed, blocked, total, status_chat_id, status_message_id "
+                "FROM broadcasts WHERE id=?",
+                (broadcast_id,)
+            )
+            return await cur.fetchone()
+
+    async def _next_batch(self, last_user_id):
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT user_id FROM users WHERE user_id > ? "
+                "AND user_id NOT IN (SELECT user_id FROM blocked_users) "
+                "ORDER BY user_id LIMIT ?",
+                (last_user_id, self.batch_size)
+            )
+            return [r[0] for r in await cur.fetchall()]
+
+    async def _checkpoint(self, broadcast_id, progress, status="running"):
+        async with self.database.acquire() as db:
+            await db.execute(
+                "UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, blocked=?, status=? WHERE id=?",
+                (progress["last_user_id"], progress["sent"], progress["failed"], progress["blocked"],
+                 status, broadcast_id)
+            )
+            await db.commit()
+
+    async def _mark_blocked(self, user_ids):
+        if not user_ids:
+            return
+        async with self.database.acquire() as db:
+            await db.executemany(
+                "INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+                [(uid, int(time.time())) for uid in user_ids]
+            )
+            await db.commit()
+
+    async def set_blocked(self, user_id, blocked):
+        """Статус из my_chat_member приватного чата: kicked — заблокировал бота, member — вернулся"""
+        async with self.database.acquire() as db:
+            if blocked:
+                await db.execute(
+                    "INSERT OR IGNORE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+                    (user_id, int(time.time()))
+                )
+            else:
+                await db.execute("DELETE FROM blocked_users WHERE user_id=?", (user_id,))
+            await db.commit()
+
+    async def _run(self, broadcast_id, report):
+        row = await self._load(broadcast_id)
+        if not row:
+            return
+        text, last_user_id, sent, failed, blocked, total, chat_id, message_id = row
+        progress = {
+            "id": broadcast_id, "last_user_id": last_user_id, "sent": sent, "failed": failed,
+            "blocked": blocked, "total": total, "status_chat_id": chat_id, "status_message_id": message_id,
+            "rate": 0.0, "eta": None, "status": "running",
+        }
+        started = time.monotonic()
+        done_at_start = sent + failed + blocked
+        last_report = 0.0
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        newly_blocked = []
+
+        async def worker():
+            while True:
+                user_id = await queue.get()
+                try:
+                    if await self.outbox.deliver(user_id, text):
+                        progress["sent"] += 1
+                    else:
+                        progress["failed"] += 1
+                except TelegramForbiddenError:
+                    progress["blocked"] += 1
+                    newly_blocked.append(user_id)
+                except Exception:
+                    progress["failed"] += 1
+                    log.exception("broadcast %s: send to %s failed", broadcast_id, user_id)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        status = "done"
+        try:
+            while True:
+                if broadcast_id in self._cancelled:
+                    status = "cancelled"
+                    break
+                batch = await self._next_batch(progress["last_user_id"])
+                if not batch:
+                    break
+                for user_id in batch:
+                    await queue.put(user_id)
+                await queue.join()
+                # чекпоинт только после того, как вся пачка отправлена
+                progress["last_user_id"] = batch[-1]
+                await self._mark_blocked(newly_blocked)
+                newly_blocked.clear()
+                await self._checkpoint(broadcast_id, progress)
+                done = progress["sent"] + progress["failed"] + progress["blocked"]
+                elapsed = time.monotonic() - started
+                progress["rate"] = (done - done_at_start) / elapsed if elapsed > 0 else 0.0
+                progress["eta"] = (max(0, total - done) / progress["rate"]) if progress["rate"] else None
+                if report and time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    await self._report(report, progress)
+            progress["status"] = status
+            await self._checkpoint(broadcast_id, progress, status)
+            self._cancelled.discard(broadcast_id)
+            if report:
+                await self._report(report, progress)
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def _report(self, report, progress):
+        try:
+            await report(dict(progress))
+        except Exception:
+            log.exception("broadcast report failed")
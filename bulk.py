@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import re
+import secrets
+import time
+import uuid
+from itertools import islice
+
+from counters import ALL_TIME
+
+log = logging.getLogger(__name__)
+
+# deep link: start-параметр до 64 символов из [A-Za-z0-9_-], "promo_" съедает 6
+CODE_RE = re.compile(r"^[A-Za-z0-9_-]{1,58}$")
+_SPLIT = re.compile(r"[,;\t]")
+_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # без O/0, I/1 — коды переписывают руками
+
+
+def _positive(value):
+    value = value.strip()
+    return int(value) if value.isdigit() and int(value) > 0 else None
+
+
+def parse_promo_lines(lines, errors, stars=None, activations=None, max_rows=100000):
+    """
+    Потоковый разбор файла промокодов: строка — "код[,звёзды[,активации]]"
+    (разделитель , ; или табуляция). Недостающие поля берутся из stars/activations.
+    Генератор (code, stars, activations); отбракованные строки — (номер строки, причина) в errors.
+    """
+    seen = set()
+    rows = 0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        fields = _SPLIT.split(line)
+        if lineno == 1 and fields[0].strip().lower() in ("code", "код"):
+            continue  # заголовок CSV
+        code = fields[0].strip()
+        row_stars = _positive(fields[1]) if len(fields) > 1 else stars
+        row_activations = _positive(fields[2]) if len(fields) > 2 else activations
+        if not CODE_RE.match(code):
+            reason = "недопустимый код"
+        elif row_stars is None:
+            reason = "нет числа звёзд"
+        elif row_activations is None:
+            reason = "нет числа активаций"
+        elif code in seen:
+            reason = "повтор в файле"
+        elif rows >= max_rows:
+            reason = f"больше {max_rows} строк"
+        else:
+            seen.add(code)
+            rows += 1
+            yield code, row_stars, row_activations
+            continue
+        errors.append((lineno, reason))
+
+
+def generate_codes(prefix, count, stars, activations, length=8):
+    """count случайных кодов вида PREFIX-XXXXXXXX"""
+    for _ in range(count):
+        suffix = "".join(secrets.choice(_ALPHABET) for _ in range(length))
+        yield f"{prefix}-{suffix}" if prefix else suffix, stars, activations
+
+
+def _chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkCreator:
+    """
+    Массовое создание промокодов и чеков: строки приходят генератором и пишутся
+    executemany пачками по chunk_size, каждая пачка — своя короткая транзакция,
+    так что обработчики пользователей не ждут всю операцию.
+    """
+
+    def __init__(self, database, counters, chunk_size=500):
+        self.database = database
+        self.counters = counters
+        self.chunk_size = chunk_size
+        self.created = 0
+        self.duplicates = 0
+        self.busy_total = 0.0
+
+    async def create_promos(self, rows):
+        """rows — (code, stars, activations); уже существующие коды пропускаются"""
+        started = time.perf_counter()
+        created = []
+        duplicates = 0
+        for chunk in _chunks(rows, self.chunk_size):
+            async with self.database.acquire() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                cur = await db.execute(
+                    f"SELECT code FROM promo_codes WHERE code IN ({','.join('?' * len(chunk))})",
+                    [code for code, _, _ in chunk]
+                )
+                existing = {r[0] for r in await cur.fetchall()}
+                fresh = [row for row in chunk if row[0] not in existing]
+                await db.executemany(
+                    "INSERT INTO promo_codes (code, stars, activations_left) VALUES (?, ?, ?)", fresh
+                )
+                await self.counters.bump(db, "promos_active", len(fresh), day=ALL_TIME)
+                await db.commit()
+            created.extend(fresh)
+            duplicates += len(chunk) - len(fresh)
+            await asyncio.sleep(0)
+        return self._result("promos", created, duplicates, started)
+
+    async def create_checks(self, creator_id, count, stars, activations, expires_at=None):
+        """count чеков по activations активаций на stars звёзд; баланс создателя не списывается (funded = 0)"""
+        started = time.perf_counter()
+        created = []
+        rows = (
+            (uuid.uuid4().hex[:12], creator_id, stars * activations, activations, stars, expires_at)
+            for _ in range(count)
+        )
+        for chunk in _chunks(rows, self.chunk_size):
+            async with self.database.acquire() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                await db.executemany(
+                    "INSERT INTO checks (check_id, creator_id, total_stars, activations_left, stars_per_activation, "
+                    "expires_at, funded) VALUES (?, ?, ?, ?, ?, ?, 0)", chunk
+                )
+                await self.counters.bump(db, "checks_active", len(chunk), day=ALL_TIME)
+                await db.commit()
+            created.extend((check_id, stars, activations) for check_id, *_ in chunk)
+            await asyncio.sleep(0)
+        return self._result("checks", created, 0, started)
+
+    def _result(self, kind, created, duplicates, started):
+        elapsed = time.perf_counter() - started
+        self.created += len(created)
+        self.duplicates += duplicates
+        self.busy_total += elapsed
+        log.info("bulk %s: %s created, %s duplicates in %.2fs", kind, len(created), duplicates, elapsed)
+        return {
+            "created": created,
+            "duplicates": duplicates,
+            "elapsed": elapsed,
+            "rate": len(created) / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def stats(self):
+        return {"created": self.created, "duplicates": self.duplicates, "busy_total_s": self.busy_total}
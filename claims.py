@@ -0,0 +1,198 @@
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+
+from counters import ALL_TIME
+from ledger import replayed_update, mark_update
+from migrations import LEGACY_ACTIVATIONS
+
+# статусы результата активации
+CLAIM_OK = "ok"
+CLAIM_NOT_FOUND = "not_found"
+CLAIM_EXHAUSTED = "exhausted"
+CLAIM_DUPLICATE = "duplicate"
+CLAIM_EXPIRED = "expired"
+
+
+class ClaimResult:
+    __slots__ = ("status", "stars", "activations_left", "creator_id")
+
+    def __init__(self, status, stars=0, activations_left=0, creator_id=None):
+        self.status = status
+        self.stars = stars
+        self.activations_left = activations_left
+        self.creator_id = creator_id
+
+    @property
+    def ok(self):
+        return self.status == CLAIM_OK
+
+
+class HotCounters:
+    """
+    Счётчики оставшихся активаций для недавно активируемых чеков/промокодов (LRU).
+    Активации только уменьшаются, поэтому известный ноль — надёжный повод
+    отказать без обращения к БД.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._left = OrderedDict()
+        self.rejected = 0
+
+    def is_exhausted(self, key):
+        left = self._left.get(key)
+        if left is None:
+            return False
+        self._left.move_to_end(key)
+        if left <= 0:
+            self.rejected += 1
+            return True
+        return False
+
+    def update(self, key, left):
+        self._left[key] = left
+        self._left.move_to_end(key)
+        if len(self._left) > self.max_size:
+            self._left.popitem(last=False)
+
+
+class ClaimEngine:
+    """
+    Активация чеков и промокодов одной транзакцией:
+    условный декремент (activations_left > 0 ... RETURNING), запись активации и проводка в ledger.
+    Создание оплаченного чека — тоже здесь: списание и INSERT в одной транзакции.
+    """
+
+    def __init__(self, database, ledger, counters, hot_size=10000):
+        self.database = database
+        self.ledger = ledger
+        self.counters = counters
+        self.checks = HotCounters(hot_size)
+        self.promos = HotCounters(hot_size)
+        # пока идёт перенос check_activations_legacy, дубли проверяются и там
+        self.legacy_activations = False
+
+    async def _in_legacy(self, db, key, user_id):
+        if not self.legacy_activations:
+            return False
+        try:
+            cur = await db.execute(
+                f"SELECT 1 FROM {LEGACY_ACTIVATIONS} WHERE check_id=? AND user_id=?", (key, user_id)
+            )
+        except sqlite3.OperationalError:
+            # перенос закончил другой процесс (BOT_WORKERS > 1) и таблицу уже удалил
+            self.legacy_activations = False
+            return False
+        return await cur.fetchone() is not None
+
+    async def create_check(self, creator_id, amount, activations, stars_per_activation, expires_at=None,
+                           update_id=None):
+        """
+        check_id нового чека или None, если звёзд не хватает. При повторной доставке того же апдейта
+        (update_id) возвращается уже созданный чек, второго списания нет.
+        """
+        check_id = uuid.uuid4().hex[:12]
+        async with self.database.acquire() as db:
+            # проверка баланса и списание — под одной блокировкой записи вместе с созданием чека
+            await db.execute("BEGIN IMMEDIATE")
+            replayed = await replayed_update(db, update_id)
+            if replayed is not None:
+                await db.rollback()
+                return replayed
+            if not await self.ledger.debit(db, creator_id, amount, "check_create", check_id):
+                await db.rollback()
+                return None
+            await db.execute(
+                "INSERT INTO checks (check_id, creator_id, total_stars, activations_left, stars_per_activation, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (check_id, creator_id, amount, activations, stars_per_activation, expires_at)
+            )
+            await self.counters.bump(db, "checks_active", day=ALL_TIME)
+            await mark_update(db, update_id, check_id)
+            await db.commit()
+        return check_id
+
+    async def claim_check(self, check_id, user_id):
+        if self.checks.is_exhausted(check_id):
+            return ClaimResult(CLAIM_EXHAUSTED)
+        async with self.database.acquire() as db:
+            # пока ждали соединение, чек мог закончиться
+            if self.checks.is_exhausted(check_id):
+                return ClaimResult(CLAIM_EXHAUSTED)
+            now = int(time.time())
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                "UPDATE checks SET activations_left = activations_left - 1 "
+                "WHERE check_id=? AND activations_left > 0 AND (expires_at IS NULL OR expires_at > ?) "
+                "RETURNING creator_id, activations_left, stars_per_activation",
+                (check_id, now)
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            if not row:
+                await db.rollback()
+                cur = await db.execute("SELECT activations_left, expires_at FROM checks WHERE check_id=?", (check_id,))
+                exists = await cur.fetchone()
+                if not exists:
+                    return ClaimResult(CLAIM_NOT_FOUND)
+                if exists[1] is not None and exists[1] <= now:
+                    # остаток вернёт создателю фоновая задача (archive.py)
+                    return ClaimResult(CLAIM_EXPIRED)
+                self.checks.update(check_id, exists[0])
+                return ClaimResult(CLAIM_EXHAUSTED)
+            creator_id, activations_left, stars = row
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO check_activations (check_id, user_id) VALUES (?, ?)",
+                (check_id, user_id)
+            )
+            if cur.rowcount == 0 or await self._in_legacy(db, check_id, user_id):
+                # уже активировал — декремент откатывается вместе с транзакцией
+                await db.rollback()
+                return ClaimResult(CLAIM_DUPLICATE)
+            await self.ledger.credit(db, user_id, stars, "check", check_id)
+            if activations_left == 0:
+                await self.counters.bump(db, "checks_active", -1, day=ALL_TIME)
+            await db.commit()
+        self.checks.update(check_id, activations_left)
+        return ClaimResult(CLAIM_OK, stars, activations_left, creator_id)
+
+    async def claim_promo(self, code, user_id):
+        if self.promos.is_exhausted(code):
+            return ClaimResult(CLAIM_EXHAUSTED)
+        async with self.database.acquire() as db:
+            # пока ждали соединение, промокод мог закончиться
+            if self.promos.is_exhausted(code):
+                return ClaimResult(CLAIM_EXHAUSTED)
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                "UPDATE promo_codes SET activations_left = activations_left - 1 "
+                "WHERE code=? AND activations_left > 0 "
+                "RETURNING id, stars, activations_left",
+                (code,)
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            if not row:
+                await db.rollback()
+                cur = await db.execute("SELECT activations_left FROM promo_codes WHERE code=?", (code,))
+                exists = await cur.fetchone()
+                if not exists:
+                    return ClaimResult(CLAIM_NOT_FOUND)
+                self.promos.update(code, exists[0])
+                return ClaimResult(CLAIM_EXHAUSTED)
+            promo_id, stars, activations_left = row
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO promo_activations (promo_id, user_id) VALUES (?, ?)",
+                (promo_id, user_id)
+            )
+            if cur.rowcount == 0 or await self._in_legacy(db, f"promo_{code}", user_id):
+                await db.rollback()
+                return ClaimResult(CLAIM_DUPLICATE)
+            await self.ledger.credit(db, user_id, stars, "promo", code)
+            if activations_left == 0:
+                await self.counters.bump(db, "promos_active", -1, day=ALL_TIME)
+            await db.commit()
+        self.promos.update(code, activations_left)
+        return ClaimResult(CLAIM_OK, stars, activations_left)
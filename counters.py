@@ -0,0 +1,108 @@
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+DAY = 86400
+ALL_TIME = 0  # day для счётчиков-состояний (активные чеки и т.п.)
+
+
+def today():
+    return int(time.time()) // DAY
+
+
+class Counters:
+    """
+    Агрегаты для админского /stats в таблице stats_counters (key, day) -> (count, total).
+    Обновляются UPSERT'ом в той же транзакции, что и само изменение (проводка, новый
+    пользователь, чек), так что /stats не сканирует users/ledger/check_activations.
+    Ключи: ledger:<reason> — по дням; users — новые пользователи по дням;
+    checks_active / promos_active — текущее число (day = 0).
+    rebuild() пересчитывает всё из базовых таблиц (при старте), dashboard() кэшируется на ttl секунд.
+    """
+
+    def __init__(self, database, ttl=30, top_size=10):
+        self.database = database
+        self.ttl = ttl
+        self.top_size = top_size
+        self._cached = None
+        self._cached_at = 0.0
+        self.bumps = 0
+        self.cache_hits = 0
+        self.rebuilt = 0
+
+    async def bump(self, db, key, count=1, total=0, day=None):
+        """Вызывается внутри транзакции вызывающего"""
+        await db.execute(
+            "INSERT INTO stats_counters (key, day, count, total) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key, day) DO UPDATE SET count = count + excluded.count, total = total + excluded.total",
+            (key, today() if day is None else day, count, total)
+        )
+        self.bumps += 1
+
+    async def rebuild(self):
+        """
+        Пересчёт из базовых таблиц. Тяжёлая часть (журнал до id W) считается обычным чтением,
+        под блокировкой записи — только хвост журнала после W и небольшие таблицы.
+        """
+        started = time.perf_counter()
+        async with self.database.acquire() as db:
+            cur = await db.execute("SELECT coalesce(max(id), 0) FROM ledger")
+            watermark = (await cur.fetchone())[0]
+            cur = await db.execute(
+                f"SELECT 'ledger:' || reason, created_at / {DAY}, count(*), sum(amount) FROM ledger "
+                "WHERE id <= ? GROUP BY 1, 2", (watermark,)
+            )
+            ledger_rows = await cur.fetchall()
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                f"SELECT 'ledger:' || reason, created_at / {DAY}, count(*), sum(amount) FROM ledger "
+                "WHERE id > ? GROUP BY 1, 2", (watermark,)
+            )
+            ledger_rows += await cur.fetchall()
+            cur = await db.execute(f"SELECT 'users', coalesce(created_at / {DAY}, 0), count(*), 0 FROM users GROUP BY 2")
+            rows = await cur.fetchall()
+            cur = await db.execute("SELECT 'checks_active', 0, count(*), 0 FROM checks WHERE activations_left > 0")
+            rows += await cur.fetchall()
+            cur = await db.execute("SELECT 'promos_active', 0, count(*), 0 FROM promo_codes WHERE activations_left > 0")
+            rows += await cur.fetchall()
+            await db.execute("DELETE FROM stats_counters")
+            await db.executemany(
+                "INSERT INTO stats_counters (key, day, count, total) VALUES (?, coalesce(?, 0), ?, ?) "
+                "ON CONFLICT (key, day) DO UPDATE SET count = count + excluded.count, total = total + excluded.total",
+                ledger_rows + rows
+            )
+            await db.commit()
+        self._cached = None
+        self.rebuilt += 1
+        log.info("stats counters rebuilt in %.2fs", time.perf_counter() - started)
+
+    async def dashboard(self):
+        now = time.monotonic()
+        if self._cached is not None and now - self._cached_at < self.ttl:
+            self.cache_hits += 1
+            return self._cached
+        day = today()
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT key, sum(count), sum(total), sum(CASE WHEN day = ? THEN count ELSE 0 END), "
+                "sum(CASE WHEN day = ? THEN total ELSE 0 END) FROM stats_counters GROUP BY key",
+                (day, day)
+            )
+            counters = {key: (count, total, count_today, total_today)
+                        for key, count, total, count_today, total_today in await cur.fetchall()}
+            # лидерборд — по частичному индексу на invited_count, без скана users
+            cur = await db.execute(
+                "SELECT user_id, username, first_name, invited_count FROM users "
+                "WHERE invited_count > 0 ORDER BY invited_count DESC LIMIT ?", (self.top_size,)
+            )
+            top = await cur.fetchall()
+            cur = await db.execute("SELECT count(*), coalesce(sum(amount), 0) FROM withdrawals WHERE status='pending'")
+            pending = await cur.fetchone()
+        self._cached = {"counters": counters, "top": top, "pending_withdrawals": pending, "built_at": time.time()}
+        self._cached_at = now
+        return self._cached
+
+    def stats(self):
+        return {"bumps": self.bumps, "cache_hits": self.cache_hits, "rebuilt": self.rebuilt}
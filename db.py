@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+log = logging.getLogger(__name__)
+
+
+class TimedConnection:
+    """Обёртка соединения: время и число запросов отдаются в observer(sql, seconds)"""
+
+    __slots__ = ("_conn", "_observer")
+
+    def __init__(self, conn, observer):
+        self._conn = conn
+        self._observer = observer
+
+    async def execute(self, sql, parameters=None):
+        started = time.perf_counter()
+        try:
+            return await self._conn.execute(sql, parameters)
+        finally:
+            self._observer(sql, time.perf_counter() - started)
+
+    async def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return await self._conn.executemany(sql, parameters)
+        finally:
+            self._observer(sql, time.perf_counter() - started)
+
+    async def commit(self):
+        started = time.perf_counter()
+        try:
+            return await self._conn.commit()
+        finally:
+            self._observer("COMMIT", time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class Database:
+    """
+    Небольшой пул долгоживущих соединений aiosqlite.
+    Соединения открываются один раз (WAL, synchronous=NORMAL, busy_timeout)
+    и выдаются обработчикам через acquire() вместо aiosqlite.connect() на каждый апдейт.
+    """
+
+    def __init__(self, path, size=4, busy_timeout_ms=5000, cached_statements=256):
+        self.path = path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._conns = []
+        self._idle = None
+        self.observer = None  # callable(sql, seconds), см. metrics.Metrics.observe_db
+        # статистика ожидания пула
+        self.acquisitions = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0  # сколько соединения были заняты — грубая оценка времени в БД
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            cached_statements=self.cached_statements,
+        )
+        # до перехода в WAL: новый файл сразу создаётся с incremental vacuum (archive.py),
+        # у существующих баз режим сменится только после разового VACUUM
+        await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        return conn
+
+    async def open(self):
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await self._connect()
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self._conns:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+        self._conns = []
+        self._idle = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Берёт соединение из пула; незакоммиченная транзакция откатывается при возврате."""
+        if self._idle is None:
+            raise RuntimeError("Database is not opened, call init_db() first")
+        started = time.perf_counter()
+        if self._idle.empty():
+            self.waits += 1
+        conn = await self._idle.get()
+        waited = time.perf_counter() - started
+        self.acquisitions += 1
+        self.wait_total += waited
+        if waited > self.wait_max:
+            self.wait_max = waited
+        try:
+            yield TimedConnection(conn, self.observer) if self.observer else conn
+        finally:
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+            except Exception:
+                log.exception("rollback on release failed")
+            self.hold_total += time.perf_counter() - started - waited
+            self._idle.put_nowait(conn)
+
+    def stats(self):
+        idle = self._idle.qsize() if self._idle is not None else 0
+        return {
+            "size": self.size,
+            "in_use": len(self._conns) - idle,
+            "acquisitions": self.acquisitions,
+            "waits": self.waits,
+            "wait_avg_ms": (self.wait_total / self.acquisitions * 1000) if self.acquisitions else 0.0,
+            "wait_max_ms": self.wait_max * 1000,
+            "hold_total_s": self.hold_total,
+        }
@@ -0,0 +1,128 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DEFAULT_DESTINY
+
+log = logging.getLogger(__name__)
+
+
+def _key(key):
+    """Компактный строковый ключ: bot:chat:user[:thread][:business][:destiny]"""
+    parts = [str(key.bot_id), str(key.chat_id), str(key.user_id)]
+    if key.thread_id is not None or key.business_connection_id or key.destiny != DEFAULT_DESTINY:
+        parts.append("" if key.thread_id is None else str(key.thread_id))
+        parts.append(key.business_connection_id or "")
+        parts.append(key.destiny)
+    return ":".join(parts)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в БД бота вместо MemoryStorage: состояние переживает рестарт
+    и доступно нескольким процессам. Брошенные диалоги истекают по TTL и
+    удаляются пачками; перед таблицей — небольшой read-through кэш.
+    """
+
+    def __init__(self, database, ttl=86400, cache_size=10000, cache_ttl=30,
+                 cleanup_interval=600, cleanup_batch=500):
+        self.database = database
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self._cache = OrderedDict()  # key -> (state, data, cached_until)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _cache_put(self, k, state, data):
+        self._cache[k] = (state, data, time.monotonic() + self.cache_ttl)
+        self._cache.move_to_end(k)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, k):
+        entry = self._cache.get(k)
+        if entry and entry[2] > time.monotonic():
+            self.cache_hits += 1
+            self._cache.move_to_end(k)
+            return entry[0], entry[1]
+        self.cache_misses += 1
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT state, data FROM fsm_states WHERE key=? AND expires_at > ?",
+                (k, int(time.time()))
+            )
+            row = await cur.fetchone()
+        state, data = (row[0], json.loads(row[1]) if row[1] else {}) if row else (None, {})
+        self._cache_put(k, state, data)
+        return state, data
+
+    async def _save(self, k, state, data):
+        async with self.database.acquire() as db:
+            if state is None and not data:
+                await db.execute("DELETE FROM fsm_states WHERE key=?", (k,))
+            else:
+                await db.execute(
+                    "INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, "
+                    "expires_at=excluded.expires_at",
+                    (k, state, json.dumps(data, separators=(",", ":"), ensure_ascii=False) if data else None,
+                     int(time.time()) + self.ttl)
+                )
+            await db.commit()
+        self._cache_put(k, state, data)
+
+    async def set_state(self, key, state=None):
+        k = _key(key)
+        _, data = await self._load(k)
+        await self._save(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._load(_key(key))
+        return state
+
+    async def set_data(self, key, data):
+        k = _key(key)
+        state, _ = await self._load(k)
+        await self._save(k, state, dict(data))
+
+    async def get_data(self, key):
+        _, data = await self._load(_key(key))
+        return dict(data)
+
+    async def cleanup(self):
+        """Удаляет истёкшие диалоги пачками, чтобы не держать долгую блокировку записи"""
+        removed = 0
+        while True:
+            async with self.database.acquire() as db:
+                cur = await db.execute(
+                    "DELETE FROM fsm_states WHERE key IN "
+                    "(SELECT key FROM fsm_states WHERE expires_at <= ? LIMIT ?)",
+                    (int(time.time()), self.cleanup_batch)
+                )
+                count = cur.rowcount
+                await db.commit()
+            removed += count
+            if count < self.cleanup_batch:
+                return removed
+            await asyncio.sleep(0)
+
+    async def cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await self.cleanup()
+                if removed:
+                    log.info("fsm storage: removed %s expired states", removed)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("fsm storage cleanup failed")
+
+    async def close(self):
+        self._cache.clear()
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+# Супервизор (BOT_WORKERS > 1) после падения воркера доставляет апдейт повторно. Списания,
+# которые не защищены уникальным ключом (новый чек, новая заявка на вывод), отмечают update_id
+# в processed_updates той же транзакцией — повтор получает ref первой обработки вместо второго списания.
+async def replayed_update(db, update_id):
+    """ref первой обработки апдейта или None, если апдейт новый (update_id None — без проверки)"""
+    if update_id is None:
+        return None
+    cur = await db.execute("SELECT ref FROM processed_updates WHERE update_id=?", (update_id,))
+    row = await cur.fetchone()
+    return row[0] if row else None
+
+
+async def mark_update(db, update_id, ref):
+    if update_id is not None:
+        await db.execute(
+            "INSERT INTO processed_updates (update_id, ref, created_at) VALUES (?, ?, ?)",
+            (update_id, str(ref), int(time.time()))
+        )
+
+
+class Ledger:
+    """
+    Балансы как журнал проводок: каждое начисление/списание — строка в ledger
+    (целое amount, причина, ссылка на чек/промокод/заявку), users.balance больше не трогается.
+
+    Баланс = balance_snapshots.balance + сумма проводок с id > snapshot.ledger_id.
+    Фоновый snapshot() сворачивает новые проводки в снимки, так что «хвост» короткий,
+    а в памяти держится (баланс, id последней учтённой проводки) — чтение баланса
+    сводится к одному индексному запросу хвоста (пусто почти всегда). Хвост проверяется
+    всегда: проводки пользователю могут прийти из другого процесса (BOT_WORKERS > 1).
+    """
+
+    def __init__(self, database, counters, cache_size=100000, snapshot_batch=5000):
+        self.database = database
+        self.counters = counters
+        self.cache_size = cache_size
+        self.snapshot_batch = snapshot_batch
+        self._cache = OrderedDict()  # user_id -> (balance, ledger_id)
+        self.posted = 0
+        self.insufficient = 0
+        self.hits = 0
+        self.misses = 0
+        self.folded = 0
+
+    # --- проводки: вызываются внутри транзакции вызывающего (BEGIN IMMEDIATE) ---
+    async def credit(self, db, user_id, amount, reason, ref=None):
+        await db.execute(
+            "INSERT INTO ledger (user_id, amount, reason, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, amount, reason, ref, int(time.time()))
+        )
+        await self.counters.bump(db, "ledger:" + reason, 1, amount)
+        self.posted += 1
+
+    async def credit_many(self, db, rows, reason):
+        """rows — (user_id, amount, ref)"""
+        now = int(time.time())
+        await db.executemany(
+            "INSERT INTO ledger (user_id, amount, reason, ref, created_at) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, amount, reason, ref, now) for user_id, amount, ref in rows]
+        )
+        if rows:
+            await self.counters.bump(db, "ledger:" + reason, len(rows), sum(amount for _, amount, _ in rows))
+        self.posted += len(rows)
+
+    async def debit(self, db, user_id, amount, reason, ref=None):
+        """Списание, если хватает звёзд; False — не хватает. Нужна уже взятая блокировка записи."""
+        balance = await self._compute(db, user_id)
+        if balance < amount:
+            self.insufficient += 1
+            return False
+        await self.credit(db, user_id, -amount, reason, ref)
+        return True
+
+    # --- чтение ---
+    async def _compute(self, db, user_id):
+        cached = self._cache.get(user_id)
+        if cached is not None:
+            base, since = cached
+            self.hits += 1
+        else:
+            cur = await db.execute("SELECT balance, ledger_id FROM balance_snapshots WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+            base, since = row if row else (0, 0)
+            self.misses += 1
+        cur = await db.execute(
+            "SELECT coalesce(sum(amount), 0), max(id) FROM ledger WHERE user_id=? AND id > ?", (user_id, since)
+        )
+        delta, last = await cur.fetchone()
+        balance = base + delta
+        # внутри транзакции видны её незакоммиченные проводки — такое в кэш не кладём
+        if not db.in_transaction:
+            self._cache[user_id] = (balance, last or since)
+            self._cache.move_to_end(user_id)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return balance
+
+    async def balance(self, user_id, db=None):
+        if db is not None:
+            return await self._compute(db, user_id)
+        async with self.database.acquire() as db:
+            return await self._compute(db, user_id)
+
+    # --- снимки ---
+    async def snapshot(self):
+        """Сворачивает новые проводки в balance_snapshots пачками по snapshot_batch, каждая — своя транзакция"""
+        folded = 0
+        while True:
+            async with self.database.acquire() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                cur = await db.execute("SELECT ledger_id FROM ledger_checkpoints ORDER BY id DESC LIMIT 1")
+                row = await cur.fetchone()
+                prev = row[0] if row else 0
+                cur = await db.execute(
+                    "SELECT max(id), count(*) FROM (SELECT id FROM ledger WHERE id > ? ORDER BY id LIMIT ?)",
+                    (prev, self.snapshot_batch)
+                )
+                upto, rows = await cur.fetchone()
+                if upto is None:
+                    await db.rollback()
+                    break
+                cur = await db.execute(
+                    "INSERT INTO balance_snapshots (user_id, balance, ledger_id) "
+                    "SELECT user_id, sum(amount), ? FROM ledger WHERE id > ? AND id <= ? GROUP BY user_id "
+                    "ON CONFLICT (user_id) DO UPDATE SET balance = balance + excluded.balance, ledger_id = excluded.ledger_id",
+                    (upto, prev, upto)
+                )
+                users = cur.rowcount
+                await db.execute(
+                    "INSERT INTO ledger_checkpoints (ledger_id, created_at, users, rows) VALUES (?, ?, ?, ?)",
+                    (upto, int(time.time()), users, rows)
+                )
+                await db.commit()
+            folded += rows
+            await asyncio.sleep(0)
+        if folded:
+            self.folded += folded
+            log.info("ledger snapshot: %s entries folded", folded)
+        return folded
+
+    async def snapshot_loop(self, interval=300):
+        while True:
+            try:
+                await self.snapshot()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("ledger snapshot failed")
+            await asyncio.sleep(interval)
+
+    async def reconcile(self, batch_size=1000):
+        """
+        Сверка журнала со снимками: снимок каждого пользователя равен сумме его проводок
+        до snapshot.ledger_id, итоговые балансы не отрицательные. Только чтение, пачками по user_id.
+        """
+        started = time.perf_counter()
+        checked = 0
+        mismatches = []  # (user_id, снимок, сумма проводок)
+        negative = []  # (user_id, баланс)
+        after = -1
+        while True:
+            async with self.database.acquire() as db:
+                cur = await db.execute(
+                    "SELECT s.user_id, s.balance, "
+                    "(SELECT coalesce(sum(amount), 0) FROM ledger l WHERE l.user_id = s.user_id AND l.id <= s.ledger_id), "
+                    "(SELECT coalesce(sum(amount), 0) FROM ledger l WHERE l.user_id = s.user_id AND l.id > s.ledger_id) "
+                    "FROM balance_snapshots s WHERE s.user_id > ? ORDER BY s.user_id LIMIT ?",
+                    (after, batch_size)
+                )
+                rows = await cur.fetchall()
+            if not rows:
+                break
+            for user_id, snapshot, folded, tail in rows:
+                if snapshot != folded:
+                    mismatches.append((user_id, snapshot, folded))
+                if snapshot + tail < 0:
+                    negative.append((user_id, snapshot + tail))
+            checked += len(rows)
+            after = rows[-1][0]
+            await asyncio.sleep(0)
+        # пользователи, у которых есть проводки, но ещё нет снимка
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT user_id, sum(amount) FROM ledger "
+                "WHERE user_id NOT IN (SELECT user_id FROM balance_snapshots) GROUP BY user_id HAVING sum(amount) < 0"
+            )
+            negative.extend(await cur.fetchall())
+            cur = await db.execute("SELECT count(*), coalesce(sum(amount), 0) FROM ledger")
+            entries, total = await cur.fetchone()
+        return {
+            "checked": checked,
+            "entries": entries,
+            "total": total,
+            "mismatches": mismatches,
+            "negative": negative,
+            "elapsed": time.perf_counter() - started,
+        }
+
+    def stats(self):
+        return {
+            "cached": len(self._cache),
+            "posted": self.posted,
+            "insufficient": self.insufficient,
+            "hits": self.hits,
+            "misses": self.misses,
+            "folded": self.folded,
+        }
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+def status_value(status):
+    # ChatMemberStatus — str-enum, str() от него даёт имя класса, а не значение
+    return getattr(status, "value", status)
+
+
+class MembershipCache:
+    """
+    Зеркало подписчиков канала: таблица channel_members обновляется из chat_member апдейтов,
+    перед ней — TTL-кэш с положительными и отрицательными записями.
+    get_chat_member вызывается только при промахе, одновременные проверки одного
+    пользователя ждут один общий запрос.
+    Строка подписчика доверяется до stale_after (потом сверка в фоне), строка не-подписчика —
+    только negative_ttl: человек подписался как раз для проверки, и ответ нужен сразу.
+    """
+
+    def __init__(self, database, bot, channel, positive_ttl=600, negative_ttl=30,
+                 stale_after=86400, reverify_interval=60, reverify_batch=20, max_size=100000):
+        self.database = database
+        self.bot = bot
+        self.channel = channel
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_after = stale_after
+        self.reverify_interval = reverify_interval
+        self.reverify_batch = reverify_batch
+        self.max_size = max_size
+        self._cache = {}  # user_id -> (is_member, expires_at)
+        self._inflight = {}  # user_id -> Future
+        self._stale = set()
+        # счётчики
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.api_errors = 0
+        self.rechecks = 0
+
+    def _remember(self, user_id, is_member, now=None):
+        now = now or time.monotonic()
+        if len(self._cache) >= self.max_size:
+            # грубая очистка: сначала выкидываем протухшие, иначе всё
+            expired = [k for k, (_, exp) in self._cache.items() if exp <= now]
+            for k in expired:
+                del self._cache[k]
+            if len(self._cache) >= self.max_size:
+                self._cache.clear()
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        self._cache[user_id] = (is_member, now + ttl)
+
+    async def is_member(self, user_id):
+        now = time.monotonic()
+        cached = self._cache.get(user_id)
+        if cached and cached[1] > now:
+            self.hits += 1
+            return cached[0]
+        fut = self._inflight.get(user_id)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = fut
+        try:
+            result = await self._lookup(user_id)
+            fut.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # исключение уже передано ожидающим, своё пробрасываем как есть
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(user_id, None)
+
+    async def _lookup(self, user_id):
+        async with self.database.acquire() as db:
+            cur = await db.execute("SELECT status, updated_at FROM channel_members WHERE user_id=?", (user_id,))
+            row = await cur.fetchone()
+        if row:
+            status, updated_at = row
+            is_member = status in MEMBER_STATUSES
+            age = time.time() - updated_at
+            if not is_member and age > self.negative_ttl:
+                self.rechecks += 1
+                return await self._fetch(user_id)
+            self.db_hits += 1
+            if age > self.stale_after:
+                # отвечаем по зеркалу, а сверку с Telegram делаем в фоне
+                self._stale.add(user_id)
+            self._remember(user_id, is_member)
+            return is_member
+        self.misses += 1
+        return await self._fetch(user_id)
+
+    async def _fetch(self, user_id, background=False):
+        try:
+            member = await self.bot.get_chat_member(chat_id=self.channel, user_id=user_id)
+        except Exception:
+            self.api_errors += 1
+            if not background:
+                # короткая отрицательная запись, чтобы не долбить API при ошибках
+                self._remember(user_id, False)
+            return False
+        await self.store(user_id, status_value(member.status))
+        return member.status in MEMBER_STATUSES
+
+    async def store(self, user_id, status):
+        """Записывает статус в зеркало и кэш (из chat_member апдейта или ответа API)"""
+        async with self.database.acquire() as db:
+            await db.execute(
+                "INSERT INTO channel_members (user_id, status, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at",
+                (user_id, status, int(time.time()))
+            )
+            await db.commit()
+        self._stale.discard(user_id)
+        self._remember(user_id, status in MEMBER_STATUSES)
+
+    async def reverify_loop(self):
+        """Фоновая сверка устаревших записей зеркала с get_chat_member"""
+        while True:
+            await asyncio.sleep(self.reverify_interval)
+            try:
+                await self.reverify_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("membership reverify failed")
+
+    async def reverify_once(self):
+        batch = []
+        while self._stale and len(batch) < self.reverify_batch:
+            batch.append(self._stale.pop())
+        if len(batch) < self.reverify_batch:
+            async with self.database.acquire() as db:
+                cur = await db.execute(
+                    "SELECT user_id FROM channel_members WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+                    (int(time.time() - self.stale_after), self.reverify_batch - len(batch))
+                )
+                batch.extend(r[0] for r in await cur.fetchall() if r[0] not in batch)
+        for user_id in batch:
+            await self._fetch(user_id, background=True)
+        return len(batch)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "api_errors": self.api_errors,
+            "rechecks": self.rechecks,
+            "cached": len(self._cache),
+            "stale": len(self._stale),
+        }
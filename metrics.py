@@ -0,0 +1,201 @@
+import bisect
+import contextvars
+import logging
+import time
+
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def escape_label(value):
+    """Экранирование значения метки по формату экспозиции Prometheus"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Минимальная prometheus-гистограмма с одной меткой (без prometheus_client)"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [bucket counts..., sum, count]
+
+    def observe(self, value, label_value):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            label_value = escape_label(label_value)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series[-1]}')
+        return lines
+
+
+class UpdateTrace:
+    """Разбивка времени одного апдейта: БД и Bot API"""
+
+    __slots__ = ("db_time", "db_queries", "api_time", "api_calls")
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.api_time = 0.0
+        self.api_calls = {}
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def handler_label(update, commands=(), callbacks=()):
+    """
+    Метка обработчика из фиксированного набора: команды и callback_data приходят от клиента,
+    и каждая новая строка иначе стала бы отдельной серией гистограммы навсегда.
+    callbacks — точные значения или префиксы с "_" на конце (wd_ -> cb:wd_*); прочее — other.
+    """
+    if update.callback_query is not None:
+        data = update.callback_query.data or ""
+        for known in callbacks:
+            if data == known:
+                return "cb:" + known
+            if known.endswith("_") and data.startswith(known):
+                return f"cb:{known}*"
+        return "cb:other"
+    if update.message is not None:
+        text = update.message.text or ""
+        if not text.startswith("/"):
+            return "message"
+        parts = text.split(maxsplit=1)
+        command = parts[0].split("@")[0]
+        if command not in commands:
+            return "command:other"
+        if command == "/start" and len(parts) > 1:
+            arg = parts[1]
+            kind = "claim" if arg.startswith("claim_") else "promo" if arg.startswith("promo_") else "ref"
+            return f"{command} {kind}"
+        return command
+    return update.event_type or "unknown"
+
+
+class Metrics:
+    """
+    Инструментация: middleware диспетчера (время обработчика), наблюдатель запросов БД
+    и middleware aiohttp-сессии бота (время методов Bot API). Экспорт — /metrics
+    в формате Prometheus, медленные апдейты пишутся в лог с разбивкой.
+    """
+
+    def __init__(self, slow_threshold=1.0, commands=(), callbacks=()):
+        self.slow_threshold = slow_threshold
+        self.commands = frozenset(commands)
+        self.callbacks = tuple(callbacks)
+        self.updates = Histogram("bot_update_seconds", "Update handling time", "handler")
+        self.db = Histogram("bot_db_query_seconds", "SQLite statement time", "op")
+        self.api = Histogram("bot_api_request_seconds", "Bot API request time", "method")
+        self.slow_updates = 0
+        self.failed_updates = 0
+        self._gauges = []  # (prefix, fn -> dict)
+        self.listeners = []  # fn(update, seconds, failed) — например, bench.py
+
+    def add_gauges(self, prefix, fn):
+        """Числовые значения из stats() подсистем (пул БД, outbox и т.п.)"""
+        self._gauges.append((prefix, fn))
+
+    # --- dispatcher middleware ---
+    async def update_middleware(self, handler, update, data):
+        trace = UpdateTrace()
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(update, data)
+        except Exception:
+            self.failed_updates += 1
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            current_trace.reset(token)
+            label = handler_label(update, self.commands, self.callbacks)
+            self.updates.observe(elapsed, label)
+            for listener in self.listeners:
+                listener(update, elapsed, failed)
+            if elapsed >= self.slow_threshold:
+                self.slow_updates += 1
+                log.warning(
+                    "slow update %s (%s): %.0f ms, db %.0f ms/%d queries, api %.0f ms %s",
+                    update.update_id, label, elapsed * 1000, trace.db_time * 1000, trace.db_queries,
+                    trace.api_time * 1000, trace.api_calls,
+                )
+
+    # --- database observer ---
+    def observe_db(self, sql, elapsed):
+        self.db.observe(elapsed, sql.lstrip().split(None, 1)[0].upper() if sql.strip() else "?")
+        trace = current_trace.get()
+        if trace is not None:
+            trace.db_time += elapsed
+            trace.db_queries += 1
+
+    # --- endpoint ---
+    def render(self):
+        lines = self.updates.render() + self.db.render() + self.api.render()
+        lines += [
+            "# TYPE bot_updates_slow_total counter", f"bot_updates_slow_total {self.slow_updates}",
+            "# TYPE bot_updates_failed_total counter", f"bot_updates_failed_total {self.failed_updates}",
+        ]
+        for prefix, fn in self._gauges:
+            try:
+                values = fn()
+            except Exception:
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def serve(self, host, port):
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+class ApiTimingMiddleware(BaseRequestMiddleware):
+    """Хук aiohttp-сессии бота: время каждого метода Bot API"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            name = getattr(method, "__api_method__", type(method).__name__)
+            self.metrics.api.observe(elapsed, name)
+            trace = current_trace.get()
+            if trace is not None:
+                trace.api_time += elapsed
+                trace.api_calls[name] = trace.api_calls.get(name, 0) + 1
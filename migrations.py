@@ -0,0 +1,345 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+LEGACY_ACTIVATIONS = "check_activations_legacy"
+
+
+async def _v1_base_schema(db):
+    """Схема до появления версий: всё через IF NOT EXISTS, старые базы проходят без изменений"""
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        balance REAL DEFAULT 0,
+        ref_id INTEGER,
+        ref_bonus INTEGER DEFAULT 0,
+        invited_count INTEGER DEFAULT 0
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS checks (
+        check_id TEXT PRIMARY KEY,
+        creator_id INTEGER,
+        total_stars INTEGER,
+        activations_left INTEGER,
+        stars_per_activation INTEGER
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS check_activations (
+        check_id TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (check_id, user_id)
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS channel_members (
+        user_id INTEGER PRIMARY KEY,
+        status TEXT,
+        updated_at INTEGER
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT,
+        expires_at INTEGER
+    ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT,
+        created_by INTEGER,
+        created_at INTEGER,
+        status TEXT,
+        last_user_id INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        status_chat_id INTEGER,
+        status_message_id INTEGER
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        user_id INTEGER PRIMARY KEY,
+        blocked_at INTEGER
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS promo_codes (
+        code TEXT PRIMARY KEY,
+        stars INTEGER,
+        activations_left INTEGER
+    )
+    """)
+
+
+async def _v2_activation_tables(db):
+    """
+    - promo_codes получает явный id INTEGER PRIMARY KEY (= старый rowid, не меняется при VACUUM);
+    - активации промокодов — отдельная promo_activations (promo_id, user_id) WITHOUT ROWID;
+    - check_activations пересоздаётся как WITHOUT ROWID, старая таблица переименовывается
+      в check_activations_legacy и переносится фоном (backfill_activations);
+    - индекс на users.ref_id.
+    Все шаги O(1) или по маленькой таблице промокодов — старт бота не задерживается.
+    """
+    await db.execute("""
+    CREATE TABLE promo_codes_v2 (
+        id INTEGER PRIMARY KEY,
+        code TEXT NOT NULL UNIQUE,
+        stars INTEGER,
+        activations_left INTEGER
+    )
+    """)
+    await db.execute(
+        "INSERT INTO promo_codes_v2 (id, code, stars, activations_left) "
+        "SELECT rowid, code, stars, activations_left FROM promo_codes"
+    )
+    await db.execute("DROP TABLE promo_codes")
+    await db.execute("ALTER TABLE promo_codes_v2 RENAME TO promo_codes")
+    await db.execute("""
+    CREATE TABLE promo_activations (
+        promo_id INTEGER,
+        user_id INTEGER,
+        PRIMARY KEY (promo_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    await db.execute(f"ALTER TABLE check_activations RENAME TO {LEGACY_ACTIVATIONS}")
+    await db.execute("""
+    CREATE TABLE check_activations (
+        check_id TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (check_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    cur = await db.execute(f"SELECT 1 FROM {LEGACY_ACTIVATIONS} LIMIT 1")
+    if not await cur.fetchone():
+        await db.execute(f"DROP TABLE {LEGACY_ACTIVATIONS}")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_ref_id ON users (ref_id)")
+
+
+async def _v3_withdrawals(db):
+    """Заявки на вывод: списание с баланса при создании, возврат при отклонении"""
+    await db.execute("""
+    CREATE TABLE withdrawals (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        created_at INTEGER,
+        processed_at INTEGER,
+        processed_by INTEGER
+    )
+    """)
+    # очередь админа — keyset по id внутри статуса
+    await db.execute("CREATE INDEX idx_withdrawals_status ON withdrawals (status, id)")
+    await db.execute("CREATE INDEX idx_withdrawals_user ON withdrawals (user_id)")
+
+
+async def _v4_ledger(db):
+    """
+    Журнал проводок вместо UPDATE users.balance: целые суммы, причина (check, promo, referral,
+    check_create, withdraw, withdraw_refund, opening) и ссылка на объект.
+    Текущие балансы переносятся проводками opening; users.balance дальше не обновляется.
+    """
+    await db.execute("""
+    CREATE TABLE ledger (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        reason TEXT NOT NULL,
+        ref TEXT,
+        created_at INTEGER
+    )
+    """)
+    # хвост баланса пользователя читается только из индекса
+    await db.execute("CREATE INDEX idx_ledger_user ON ledger (user_id, id, amount)")
+    await db.execute("""
+    CREATE TABLE balance_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        balance INTEGER NOT NULL,
+        ledger_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    await db.execute("""
+    CREATE TABLE ledger_checkpoints (
+        id INTEGER PRIMARY KEY,
+        ledger_id INTEGER NOT NULL,
+        created_at INTEGER,
+        users INTEGER,
+        rows INTEGER
+    )
+    """)
+    await db.execute(
+        "INSERT INTO ledger (user_id, amount, reason, created_at) "
+        "SELECT user_id, CAST(ROUND(balance) AS INTEGER), 'opening', strftime('%s', 'now') FROM users "
+        "WHERE CAST(ROUND(balance) AS INTEGER) != 0 ORDER BY user_id"
+    )
+
+
+async def _v5_expiry(db):
+    """Срок действия чеков; частичные индексы под фоновую архивацию (archive.py)"""
+    await db.execute("ALTER TABLE checks ADD COLUMN expires_at INTEGER")
+    await db.execute("CREATE INDEX idx_checks_expires ON checks (expires_at) WHERE expires_at IS NOT NULL")
+    await db.execute("CREATE INDEX idx_checks_exhausted ON checks (check_id) WHERE activations_left <= 0")
+    await db.execute("CREATE INDEX idx_promo_codes_exhausted ON promo_codes (id) WHERE activations_left <= 0")
+
+
+async def _v6_stats_counters(db):
+    """Агрегаты для /stats (counters.py), дата регистрации, частичный индекс под топ рефереров"""
+    await db.execute("""
+    CREATE TABLE stats_counters (
+        key TEXT,
+        day INTEGER,
+        count INTEGER NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (key, day)
+    ) WITHOUT ROWID
+    """)
+    await db.execute("ALTER TABLE users ADD COLUMN created_at INTEGER")
+    await db.execute("CREATE INDEX idx_users_invited ON users (invited_count) WHERE invited_count > 0")
+
+
+async def _v7_check_funding(db):
+    """
+    checks.funded: 0 — чек создан без списания (массовые чеки админа), при истечении остаток не возвращается.
+    Истекать могут только чеки с expires_at (появился в v5, после журнала v4), так что у оплаченных
+    среди них есть проводка check_create с ref = check_id; у остальных (без срока) флаг ни на что не влияет.
+    """
+    await db.execute("ALTER TABLE checks ADD COLUMN funded INTEGER NOT NULL DEFAULT 1")
+    await db.execute(
+        "UPDATE checks SET funded = 0 WHERE expires_at IS NOT NULL "
+        "AND check_id NOT IN (SELECT ref FROM ledger WHERE reason = 'check_create' AND ref IS NOT NULL)"
+    )
+
+
+async def _v8_processed_updates(db):
+    """Обработанные апдейты с неидемпотентными списаниями (ledger.replayed_update / mark_update)"""
+    await db.execute("""
+    CREATE TABLE processed_updates (
+        update_id INTEGER PRIMARY KEY,
+        ref TEXT,
+        created_at INTEGER NOT NULL
+    )
+    """)
+
+
+async def _v9_promo_autoincrement(db):
+    """
+    promo_codes.id становится AUTOINCREMENT: без него после архивации последнего промокода его id
+    выдаётся новому, и в архиве (ключ — id) новый промокод затирает старый, а активации смешиваются.
+    Таблица маленькая, пересборка — один INSERT ... SELECT; sqlite_sequence получает max(id).
+    Id, уже ушедшие в архив выше этого max, резервирует Archiver при открытии архива.
+    """
+    await db.execute("""
+    CREATE TABLE promo_codes_v9 (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL UNIQUE,
+        stars INTEGER,
+        activations_left INTEGER
+    )
+    """)
+    await db.execute(
+        "INSERT INTO promo_codes_v9 (id, code, stars, activations_left) "
+        "SELECT id, code, stars, activations_left FROM promo_codes"
+    )
+    await db.execute("DROP TABLE promo_codes")
+    await db.execute("ALTER TABLE promo_codes_v9 RENAME TO promo_codes")
+    await db.execute("CREATE INDEX idx_promo_codes_exhausted ON promo_codes (id) WHERE activations_left <= 0")
+
+
+# (версия, описание, функция); новые миграции — только в конец списка
+MIGRATIONS = [
+    (1, "base schema", _v1_base_schema),
+    (2, "promo_activations, WITHOUT ROWID activations, users.ref_id index", _v2_activation_tables),
+    (3, "withdrawals", _v3_withdrawals),
+    (4, "balance ledger and snapshots", _v4_ledger),
+    (5, "check expiry, archival indexes", _v5_expiry),
+    (6, "stats counters, users.created_at, referral leaderboard index", _v6_stats_counters),
+    (7, "checks.funded", _v7_check_funding),
+    (8, "processed_updates", _v8_processed_updates),
+    (9, "promo_codes.id AUTOINCREMENT", _v9_promo_autoincrement),
+]
+
+
+async def migrate(db):
+    """Применяет недостающие миграции, каждая — в своей транзакции вместе с PRAGMA user_version"""
+    cur = await db.execute("PRAGMA user_version")
+    version = (await cur.fetchone())[0]
+    for target, title, migration in MIGRATIONS:
+        if target <= version:
+            continue
+        await db.execute("BEGIN IMMEDIATE")
+        # несколько процессов стартуют одновременно — версию перечитываем под блокировкой
+        cur = await db.execute("PRAGMA user_version")
+        version = (await cur.fetchone())[0]
+        if target <= version:
+            await db.rollback()
+            continue
+        log.info("applying migration %s: %s", target, title)
+        try:
+            await migration(db)
+            await db.execute(f"PRAGMA user_version={target}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        version = target
+    return version
+
+
+async def legacy_activations_pending(db):
+    cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (LEGACY_ACTIVATIONS,))
+    return await cur.fetchone() is not None
+
+
+async def backfill_activations(database, on_drained=None, batch_size=500, pause=0.05):
+    """
+    Переносит строки check_activations_legacy в новые таблицы короткими транзакциями
+    (ключи promo_<code> — в promo_activations по id промокода), затем удаляет legacy-таблицу.
+    Между пачками отдаёт управление, чтобы не держать блокировку записи.
+    on_drained() вызывается под той же блокировкой, что и DROP: после него
+    обработчики больше не смотрят в legacy-таблицу.
+    """
+    moved = 0
+    while True:
+        async with database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                f"SELECT rowid, check_id, user_id FROM {LEGACY_ACTIVATIONS} ORDER BY rowid LIMIT ?",
+                (batch_size,)
+            )
+            rows = await cur.fetchall()
+            if not rows:
+                if on_drained:
+                    on_drained()
+                await db.execute(f"DROP TABLE {LEGACY_ACTIVATIONS}")
+                await db.commit()
+                log.info("activation backfill done, %s rows moved", moved)
+                return moved
+            checks = [(cid, uid) for _, cid, uid in rows if not cid.startswith("promo_")]
+            promos = [(cid[6:], uid) for _, cid, uid in rows if cid.startswith("promo_")]
+            if checks:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO check_activations (check_id, user_id) VALUES (?, ?)", checks
+                )
+            if promos:
+                await db.executemany(
+                    "INSERT OR IGNORE INTO promo_activations (promo_id, user_id) "
+                    "SELECT id, ? FROM promo_codes WHERE code=?",
+                    [(uid, code) for code, uid in promos]
+                )
+            await db.execute(
+                f"DELETE FROM {LEGACY_ACTIVATIONS} WHERE rowid <= ?", (rows[-1][0],)
+            )
+            await db.commit()
+        moved += len(rows)
+        await asyncio.sleep(pause)
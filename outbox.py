@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now=None):
+        self._refill(now or time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now=None):
+        """Сколько ждать до следующего токена (0 — можно сейчас)"""
+        self._refill(now or time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self, now=None):
+        self._refill(now or time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def take(self):
+        while not self.try_take():
+            await asyncio.sleep(self.delay())
+
+    def pause(self, seconds):
+        # RetryAfter: уводим бакет в минус, чтобы все отправители подождали
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class Outbox:
+    """
+    Асинхронная отправка сообщений: обработчики кладут сообщение в очередь и не ждут.
+    Глобальный и per-chat token bucket, RetryAfter соблюдается; уведомления
+    об активациях одного чека за окно склеиваются в одно сообщение.
+    forward(chat_id, method, args) — хук супервизора: если чат принадлежит другому воркеру,
+    send/notify_activation передаются туда (True), и склейка и лимит чата остаются в одном процессе.
+    """
+
+    def __init__(self, bot, global_rate=25, per_chat_rate=1, workers=4, coalesce_window=3.0,
+                 max_queue=10000, max_retries=3):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_rate = per_chat_rate
+        self.workers = workers
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        # у каждого чата своя FIFO-очередь, в ready — чаты, которым уже можно писать
+        self._chat_queues = {}
+        self._ready = asyncio.Queue()
+        self._queued = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._chat_buckets = {}
+        self._pending = {}  # (creator_id, check_id) -> [count, left, last_name, timer]
+        self._tasks = []
+        self.forward = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.retry_after = 0
+
+    # --- постановка в очередь ---
+    def send(self, chat_id, text, **kwargs):
+        if self.forward is not None and self.forward(chat_id, "send", (chat_id, text), kwargs):
+            return
+        if self._queued >= self.max_queue:
+            self.dropped += 1
+            log.warning("outbox full, message to %s dropped", chat_id)
+            return
+        self._queued += 1
+        self._idle.clear()
+        chat_queue = self._chat_queues.get(chat_id)
+        if chat_queue is None:
+            chat_queue = self._chat_queues[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        chat_queue.append((text, kwargs))
+
+    def notify_activation(self, creator_id, check_id, who, activations_left):
+        if self.forward is not None and self.forward(
+                creator_id, "notify_activation", (creator_id, check_id, who, activations_left), {}):
+            return
+        key = (creator_id, check_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending[0] += 1
+            pending[1] = min(pending[1], activations_left)
+            pending[2] = who
+            self.coalesced += 1
+            return
+        timer = asyncio.get_running_loop().call_later(self.coalesce_window, self._flush_activation, key)
+        self._pending[key] = [1, activations_left, who, timer]
+
+    def _flush_activation(self, key):
+        count, left, who, timer = self._pending.pop(key)
+        timer.cancel()
+        creator_id, check_id = key
+        if count == 1:
+            text = f"🎉 Ваш чек {check_id} активирован пользователем @{who}. Осталось активаций: {left}"
+        else:
+            text = f"🎉 Ваш чек {check_id}: +{count} активаций, осталось {left}"
+        self.send(creator_id, text)
+
+    # --- отправка ---
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                # выкидываем полностью восстановившиеся (давно не писали) бакеты
+                now = time.monotonic()
+                for cid in [c for c, b in self._chat_buckets.items() if b.full(now)]:
+                    del self._chat_buckets[cid]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+        return bucket
+
+    async def deliver(self, chat_id, text, **kwargs):
+        """Отправка с учётом лимитов и RetryAfter. Возвращает True/False, Forbidden пробрасывается."""
+        for _ in range(self.max_retries + 1):
+            await self._chat_bucket(chat_id).take()
+            await self.global_bucket.take()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                self.sent += 1
+                return True
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                self.global_bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                self.failed += 1
+                raise
+            except TelegramBadRequest as e:
+                self.failed += 1
+                log.info("send to %s rejected: %s", chat_id, e)
+                return False
+        self.failed += 1
+        return False
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready.get()
+            delay = self._chat_bucket(chat_id).delay()
+            if delay > 0:
+                # чат упёрся в свой лимит — вернём его позже, воркер не простаивает
+                loop.call_later(delay, self._ready.put_nowait, chat_id)
+                continue
+            chat_queue = self._chat_queues[chat_id]
+            text, kwargs = chat_queue.popleft()
+            try:
+                await self.deliver(chat_id, text, **kwargs)
+            except TelegramForbiddenError:
+                pass  # пользователь заблокировал бота
+            except Exception:
+                self.failed += 1
+                log.exception("send to %s failed", chat_id)
+            finally:
+                self._queued -= 1
+                if chat_queue:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._chat_queues[chat_id]
+                if not self._queued:
+                    self._idle.set()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout=10):
+        # отправляем накопленные сводки, не дожидаясь окна
+        for key in list(self._pending):
+            self._flush_activation(key)
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._idle.wait(), drain_timeout)
+            except asyncio.TimeoutError:
+                log.warning("outbox not drained, %s messages left", self._queued)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "queued": self._queued,
+            "pending_summaries": len(self._pending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "retry_after": self.retry_after,
+        }
@@ -0,0 +1,127 @@
+import logging
+from collections import OrderedDict
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiohttp import FormData
+from pydantic import ConfigDict
+
+log = logging.getLogger(__name__)
+
+
+class FrozenList(list):
+    """list без изменения на месте — остаётся list для схем aiogram и BaseSession.prepare_value"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("static keyboard is immutable")
+
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+
+class FrozenButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenKeyboard(InlineKeyboardMarkup):
+    """Неизменяемая клавиатура: поля не присваиваются, строки и кнопки не меняются на месте"""
+
+    model_config = ConfigDict(frozen=True)
+
+    def model_post_init(self, context):
+        super().model_post_init(context)
+        # frozen запрещает присваивание, поэтому строки подменяются напрямую в __dict__
+        self.__dict__["inline_keyboard"] = FrozenList(FrozenList(row) for row in self.inline_keyboard)
+
+
+class Renderer:
+    """
+    Готовые экраны бота:
+    - статические клавиатуры собираются один раз при старте как FrozenKeyboard, их JSON для Bot API
+      сериализуется тогда же (RenderSession подставляет его вместо model_dump + json.dumps);
+    - тексты профиля кэшируются по user_id вместе с версией (имя, юзернейм, баланс, приглашённые) —
+      пока версия та же, строка не форматируется заново.
+    Клавиатуры общие для всех ответов и неизменяемые, так что готовый JSON не устаревает.
+    """
+
+    def __init__(self, profile_cache_size=100000):
+        self.profile_cache_size = profile_cache_size
+        self._payloads = {}  # id(markup) -> (markup, json)
+        self._profiles = OrderedDict()  # user_id -> (версия, текст)
+        self.payload_hits = 0
+        self.profile_hits = 0
+        self.profile_misses = 0
+
+    def keyboard(self, rows):
+        """rows — строки кнопок [(text, callback_data | url), ...]; url распознаётся по https://"""
+        markup = FrozenKeyboard(inline_keyboard=[
+            [
+                FrozenButton(text=text, url=target) if target.startswith("https://")
+                else FrozenButton(text=text, callback_data=target)
+                for text, target in row
+            ]
+            for row in rows
+        ])
+        # тот же JSON, что собрал бы BaseSession.prepare_value (None-поля выкидываются)
+        self._payloads[id(markup)] = (markup, markup.model_dump_json(exclude_none=True))
+        return markup
+
+    def payload(self, markup):
+        entry = self._payloads.get(id(markup))
+        if entry is None or entry[0] is not markup:
+            return None
+        self.payload_hits += 1
+        return entry[1]
+
+    def profile(self, user_id, first_name, username, balance, invited):
+        version = (first_name, username, balance, invited)
+        cached = self._profiles.get(user_id)
+        if cached is not None and cached[0] == version:
+            self._profiles.move_to_end(user_id)
+            self.profile_hits += 1
+            return cached[1]
+        text = (
+            f"👤 Профиль: {first_name} (@{username})\n"
+            f"⭐ Баланс: {balance}\n"
+            f"🤝 Пригласил: {invited}"
+        )
+        self._profiles[user_id] = (version, text)
+        self._profiles.move_to_end(user_id)
+        if len(self._profiles) > self.profile_cache_size:
+            self._profiles.popitem(last=False)
+        self.profile_misses += 1
+        return text
+
+    def stats(self):
+        return {
+            "keyboards": len(self._payloads),
+            "payload_hits": self.payload_hits,
+            "profiles": len(self._profiles),
+            "profile_hits": self.profile_hits,
+            "profile_misses": self.profile_misses,
+        }
+
+
+class RenderSession(AiohttpSession):
+    """AiohttpSession, который берёт JSON зарегистрированных в Renderer клавиатур готовым"""
+
+    def __init__(self, renderer, **kwargs):
+        super().__init__(**kwargs)
+        self.renderer = renderer
+
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        payload = self.renderer.payload(markup) if markup is not None else None
+        if payload is None:
+            return super().build_form_data(bot, method)
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                form.add_field(key, value)
+        if files:
+            # у текстовых ответов файлов не бывает; если что-то пришло — обычный путь
+            return super().build_form_data(bot, method)
+        form.add_field("reply_markup", payload)
+        return form
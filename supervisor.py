@@ -0,0 +1,276 @@
+"""
+Режим супервизора (BOT_WORKERS > 1): один процесс принимает апдейты (polling или webhook)
+и раздаёт их N процессам-воркерам по from_user.id, так что FSM-диалог и активации
+пользователя всегда обрабатывает один и тот же воркер.
+
+Каждый апдейт живёт в супервизоре, пока воркер не подтвердит обработку (ack).
+Упавший воркер перезапускается, и все неподтверждённые апдейты отправляются ему заново
+в исходном порядке (доставка at-least-once). Активации защищены уникальными ключами,
+а списания без такого ключа (создание чека, заявка на вывод) отмечают update_id
+в processed_updates той же транзакцией — повтор не спишет звёзды второй раз.
+
+Сообщения через Outbox (сводки активаций создателю чека, ответы по заявкам на вывод) отправляет
+воркер, которому принадлежит чат получателя (chat_id % N, как и апдейты): чужие он пересылает
+через супервизор. Поэтому сводки одного чека склеиваются в одном процессе, а per-chat лимит
+SEND_CHAT_RATE действует целиком. Пересылка best-effort: при рестарте воркера-получателя теряется,
+как и вся его очередь Outbox. Общий SEND_RATE делится поровну, так что рассылка (идёт в одном
+воркере) отправляет не быстрее SEND_RATE / N.
+"""
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+_STOP = None
+
+
+def shard_of(chat_id, workers):
+    """Номер воркера для пользователя/чата — тот же, что у его апдейтов"""
+    return chat_id % workers
+
+
+def raw_update_user_id(raw):
+    """id отправителя по сырому JSON апдейта (без валидации в супервизоре)"""
+    for key, value in raw.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        sender = value.get("from") or value.get("user") or value.get("chat")
+        if isinstance(sender, dict) and "id" in sender:
+            return sender["id"]
+    return raw.get("update_id", 0)
+
+
+# === worker process ===
+def worker_process(index, shards, primary, in_queue, ack_queue, env):
+    # Ctrl+C получает вся группа процессов; воркер останавливает супервизор через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ.update(env)
+    asyncio.run(_worker_main(index, shards, primary, in_queue, ack_queue))
+
+
+async def _worker_main(index, shards, primary, in_queue, ack_queue):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s %(name)s: %(message)s")
+    import bot as app
+    from aiogram.types import Update
+    from webhook import UpdateWorkers
+
+    seqs = {}
+
+    def done(update):
+        ack_queue.put((index, seqs.pop(id(update))))
+
+    def forward(chat_id, method, args, kwargs):
+        target = shard_of(chat_id, shards)
+        if target == index:
+            return False
+        # seq=None — не апдейт, а вызов Outbox для воркера target
+        ack_queue.put((target, None, (method, args, kwargs)))
+        return True
+
+    app.outbox.forward = forward
+
+    workers = UpdateWorkers(app.dp, app.bot, workers=app.WEBHOOK_WORKERS, queue_size=app.WEBHOOK_QUEUE_SIZE,
+                            on_done=done)
+    await app.start_services(primary=primary)
+    await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp)
+    await workers.start_workers()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, in_queue.get)
+            if item is _STOP:
+                break
+            seq, raw = item
+            if seq is None:
+                method, args, kwargs = raw
+                getattr(app.outbox, method)(*args, **kwargs)
+                continue
+            update = Update.model_validate(raw, context={"bot": app.bot})
+            seqs[id(update)] = seq
+            await workers.submit(update)
+    finally:
+        await workers.stop_workers()
+        await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp)
+        await app.stop_services()
+        await app.bot.session.close()
+
+
+# === supervisor ===
+class WorkerSlot:
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.in_queue = None
+        self.backlog = deque()  # ещё не отправлено воркеру
+        self.unacked = OrderedDict()  # seq -> raw, отправлено, но не подтверждено
+        self.restarts = 0
+        self.processed = 0
+
+
+class Supervisor:
+    def __init__(self, workers, window=200, env=None, check_interval=1.0):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.slots = [WorkerSlot(i) for i in range(workers)]
+        self.window = window  # сколько апдейтов может быть «в полёте» у одного воркера
+        self.env = env or {}
+        self.check_interval = check_interval
+        self.ack_queue = self.ctx.Queue()
+        self._seq = 0
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._ack_thread = None
+
+    def _spawn(self, slot):
+        slot.in_queue = self.ctx.Queue()
+        env = dict(self.env)
+        env.update(slot_env(slot.index, len(self.slots)))
+        slot.process = self.ctx.Process(
+            target=worker_process,
+            args=(slot.index, len(self.slots), slot.index == 0, slot.in_queue, self.ack_queue, env),
+            name=f"bot-worker-{slot.index}",
+            daemon=True,
+        )
+        slot.process.start()
+        # всё неподтверждённое — заново и по порядку
+        for seq, raw in slot.unacked.items():
+            slot.in_queue.put((seq, raw))
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        for slot in self.slots:
+            self._spawn(slot)
+        self._ack_thread = threading.Thread(target=self._read_acks, args=(loop,), daemon=True)
+        self._ack_thread.start()
+
+    def _read_acks(self, loop):
+        while True:
+            try:
+                item = self.ack_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping and not self.pending():
+                    return
+                continue
+            loop.call_soon_threadsafe(self._on_ack, *item)
+
+    def _on_ack(self, index, seq, forwarded=None):
+        slot = self.slots[index]
+        if seq is None:
+            # пересылка Outbox другому воркеру: без seq и подтверждения, мимо окна
+            slot.in_queue.put((None, forwarded))
+            return
+        if slot.unacked.pop(seq, None) is not None:
+            slot.processed += 1
+        self._pump(slot)
+        self._wakeup.set()
+
+    def _pump(self, slot):
+        while slot.backlog and len(slot.unacked) < self.window:
+            seq, raw = slot.backlog.popleft()
+            slot.unacked[seq] = raw
+            slot.in_queue.put((seq, raw))
+
+    def dispatch(self, raw):
+        self._seq += 1
+        slot = self.slots[shard_of(raw_update_user_id(raw), len(self.slots))]
+        slot.backlog.append((self._seq, raw))
+        self._pump(slot)
+
+    def pending(self):
+        return sum(len(s.backlog) + len(s.unacked) for s in self.slots)
+
+    async def monitor(self):
+        while not self._stopping:
+            await asyncio.sleep(self.check_interval)
+            for slot in self.slots:
+                if not slot.process.is_alive():
+                    slot.restarts += 1
+                    log.warning("worker %s died (exit code %s), restarting with %s unacked updates",
+                                slot.index, slot.process.exitcode, len(slot.unacked))
+                    self._spawn(slot)
+
+    async def stop(self, drain_timeout=30):
+        self._stopping = True
+        deadline = asyncio.get_running_loop().time() + drain_timeout
+        while self.pending() and asyncio.get_running_loop().time() < deadline:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        if self.pending():
+            log.warning("supervisor stopping with %s unprocessed updates", self.pending())
+        for slot in self.slots:
+            slot.in_queue.put(_STOP)
+        for slot in self.slots:
+            await asyncio.get_running_loop().run_in_executor(None, slot.process.join, drain_timeout)
+            if slot.process.is_alive():
+                slot.process.terminate()
+
+    def stats(self):
+        out = {"pending": self.pending()}
+        for slot in self.slots:
+            out[f"worker{slot.index}_queue_depth"] = len(slot.backlog) + len(slot.unacked)
+            out[f"worker{slot.index}_processed"] = slot.processed
+            out[f"worker{slot.index}_restarts"] = slot.restarts
+        return out
+
+
+def slot_env(index, workers):
+    """Переменные окружения воркера: делим глобальный лимит отправки, разводим порты метрик.
+    SEND_CHAT_RATE не делится — сообщения Outbox одному чату шлёт только его воркер."""
+    env = {"BOT_WORKERS": "1", "BOT_WORKER_INDEX": str(index)}
+    env["SEND_RATE"] = str(float(os.getenv("SEND_RATE", "25")) / workers)
+    metrics_port = int(os.getenv("METRICS_PORT", "9100"))
+    env["METRICS_PORT"] = str(metrics_port + 1 + index) if metrics_port else "0"
+    return env
+
+
+# === ingest ===
+async def poll_updates(bot, supervisor, allowed_updates, timeout=30):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("getUpdates failed")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            supervisor.dispatch(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+            offset = update.update_id + 1
+
+
+async def serve_webhook(supervisor, host, port, path, secret):
+    from aiohttp import web
+    from webhook import SECRET_HEADER, require_secret
+
+    require_secret(host, secret)
+
+    async def handle(request):
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        try:
+            raw = await request.json()
+        except Exception:
+            return web.Response(status=400)
+        supervisor.dispatch(raw)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,91 @@
+import asyncio
+
+from claims import ClaimEngine, CLAIM_OK, CLAIM_EXHAUSTED, CLAIM_DUPLICATE
+from counters import Counters
+from db import Database
+from ledger import Ledger
+from migrations import migrate
+
+ACTIVATIONS = 5
+CLAIMERS = 20
+
+
+async def _setup(path):
+    database = Database(str(path), size=4)
+    await database.open()
+    async with database.acquire() as db:
+        await migrate(db)
+        await db.execute(
+            "INSERT INTO checks (check_id, creator_id, total_stars, activations_left, stars_per_activation) "
+            "VALUES ('chk', 1, ?, ?, 2)", (ACTIVATIONS * 2, ACTIVATIONS)
+        )
+        await db.commit()
+    counters = Counters(database)
+    return database, ClaimEngine(database, Ledger(database, counters), counters)
+
+
+def test_concurrent_claims_give_exactly_n_activations(tmp_path):
+    async def run():
+        database, claims = await _setup(tmp_path / "bot.db")
+        try:
+            results = await asyncio.gather(*(claims.claim_check("chk", user_id) for user_id in range(100, 100 + CLAIMERS)))
+            async with database.acquire() as db:
+                cur = await db.execute("SELECT activations_left FROM checks WHERE check_id='chk'")
+                left = (await cur.fetchone())[0]
+                cur = await db.execute("SELECT count(*), sum(amount) FROM ledger WHERE reason='check'")
+                credited = await cur.fetchone()
+        finally:
+            await database.close()
+        return results, left, credited
+
+    results, left, credited = asyncio.run(run())
+    statuses = [r.status for r in results]
+    assert statuses.count(CLAIM_OK) == ACTIVATIONS
+    assert statuses.count(CLAIM_EXHAUSTED) == CLAIMERS - ACTIVATIONS
+    assert left == 0
+    assert credited == (ACTIVATIONS, ACTIVATIONS * 2)
+
+
+def test_same_user_claims_once(tmp_path):
+    async def run():
+        database, claims = await _setup(tmp_path / "bot.db")
+        try:
+            results = await asyncio.gather(*(claims.claim_check("chk", 100) for _ in range(10)))
+            async with database.acquire() as db:
+                cur = await db.execute("SELECT activations_left FROM checks WHERE check_id='chk'")
+                left = (await cur.fetchone())[0]
+        finally:
+            await database.close()
+        return results, left
+
+    results, left = asyncio.run(run())
+    statuses = [r.status for r in results]
+    assert statuses.count(CLAIM_OK) == 1
+    assert statuses.count(CLAIM_DUPLICATE) == 9
+    assert left == ACTIVATIONS - 1
+
+
+def test_check_creation_replay_debits_once(tmp_path):
+    async def run():
+        database, claims = await _setup(tmp_path / "bot.db")
+        try:
+            async with database.acquire() as db:
+                await db.execute("INSERT INTO ledger (user_id, amount, reason) VALUES (7, 10, 'opening')")
+                await db.commit()
+            # одновременные повторы одного апдейта (супервизор переотправил после падения воркера)
+            ids = await asyncio.gather(*(claims.create_check(7, 10, 5, 2, update_id=500) for _ in range(3)))
+            again = await claims.create_check(7, 10, 5, 2, update_id=500)
+            async with database.acquire() as db:
+                cur = await db.execute("SELECT count(*) FROM checks WHERE creator_id=7")
+                checks = (await cur.fetchone())[0]
+                cur = await db.execute("SELECT sum(amount) FROM ledger WHERE user_id=7")
+                balance = (await cur.fetchone())[0]
+        finally:
+            await database.close()
+        return ids, again, checks, balance
+
+    ids, again, checks, balance = asyncio.run(run())
+    assert ids[0] is not None
+    assert set(ids) == {again}
+    assert checks == 1
+    assert balance == 0
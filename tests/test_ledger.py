@@ -0,0 +1,71 @@
+import asyncio
+
+from counters import Counters
+from db import Database
+from ledger import Ledger
+from migrations import migrate
+
+BALANCE = 10
+DEBITS = 30
+
+
+async def _setup(path):
+    database = Database(str(path), size=4)
+    await database.open()
+    async with database.acquire() as db:
+        await migrate(db)
+        await db.executemany(
+            "INSERT INTO ledger (user_id, amount, reason) VALUES (?, ?, 'opening')", [(1, BALANCE), (2, 5)]
+        )
+        await db.commit()
+    return database, Ledger(database, Counters(database), snapshot_batch=2)
+
+
+async def _debit(database, ledger, user_id, amount):
+    async with database.acquire() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        ok = await ledger.debit(db, user_id, amount, "test")
+        await db.commit()
+    return ok
+
+
+def test_concurrent_debits_never_go_negative(tmp_path):
+    async def run():
+        database, ledger = await _setup(tmp_path / "bot.db")
+        try:
+            # баланс прочитан в кэш до списаний — debit всё равно должен видеть чужие проводки
+            assert await ledger.balance(1) == BALANCE
+            results = await asyncio.gather(*(_debit(database, ledger, 1, 1) for _ in range(DEBITS)))
+            return results, await ledger.balance(1)
+        finally:
+            await database.close()
+
+    results, balance = asyncio.run(run())
+    assert results.count(True) == BALANCE
+    assert balance == 0
+
+
+def test_snapshot_then_reconcile(tmp_path):
+    async def run():
+        database, ledger = await _setup(tmp_path / "bot.db")
+        try:
+            await _debit(database, ledger, 1, 3)
+            folded = await ledger.snapshot()
+            await _debit(database, ledger, 2, 5)
+            report = await ledger.reconcile(batch_size=1)
+            balances = await ledger.balance(1), await ledger.balance(2)
+            # снимок лишь сворачивает журнал, балансы из снимка + хвоста те же
+            ledger._cache.clear()
+            cold = await ledger.balance(1), await ledger.balance(2)
+            return folded, report, balances, cold
+        finally:
+            await database.close()
+
+    folded, report, balances, cold = asyncio.run(run())
+    assert folded == 3
+    assert report["checked"] == 2
+    assert report["entries"] == 4
+    assert report["total"] == BALANCE + 5 - 3 - 5
+    assert report["mismatches"] == []
+    assert report["negative"] == []
+    assert balances == cold == (BALANCE - 3, 0)
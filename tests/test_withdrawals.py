@@ -0,0 +1,63 @@
+import asyncio
+
+from counters import Counters
+from db import Database
+from ledger import Ledger
+from migrations import migrate
+from withdrawals import Withdrawals
+
+BALANCE = 100
+AMOUNT = 15
+REQUESTS = 20
+
+
+async def _setup(path):
+    database = Database(str(path), size=4)
+    await database.open()
+    async with database.acquire() as db:
+        await migrate(db)
+        await db.execute("INSERT INTO ledger (user_id, amount, reason) VALUES (1, ?, 'opening')", (BALANCE,))
+        await db.commit()
+    return database, Withdrawals(database, Ledger(database, Counters(database)))
+
+
+async def _debited(database):
+    async with database.acquire() as db:
+        cur = await db.execute("SELECT count(*), coalesce(sum(amount), 0) FROM withdrawals WHERE user_id=1")
+        requests = await cur.fetchone()
+        cur = await db.execute("SELECT sum(amount) FROM ledger WHERE user_id=1")
+        balance = (await cur.fetchone())[0]
+    return requests, balance
+
+
+def test_concurrent_requests_never_overdraw(tmp_path):
+    async def run():
+        database, withdrawals = await _setup(tmp_path / "bot.db")
+        try:
+            ids = await asyncio.gather(*(withdrawals.request(1, AMOUNT) for _ in range(REQUESTS)))
+            return ids, *await _debited(database)
+        finally:
+            await database.close()
+
+    ids, requests, balance = asyncio.run(run())
+    accepted = BALANCE // AMOUNT
+    assert len([i for i in ids if i is not None]) == accepted
+    assert requests == (accepted, accepted * AMOUNT)
+    assert balance == BALANCE - accepted * AMOUNT
+
+
+def test_replayed_request_debits_once(tmp_path):
+    async def run():
+        database, withdrawals = await _setup(tmp_path / "bot.db")
+        try:
+            ids = await asyncio.gather(*(withdrawals.request(1, AMOUNT, update_id=42) for _ in range(3)))
+            again = await withdrawals.request(1, AMOUNT, update_id=42)
+            return ids, again, *await _debited(database)
+        finally:
+            await database.close()
+
+    ids, again, requests, balance = asyncio.run(run())
+    assert ids[0] is not None
+    assert set(ids) == {again}
+    assert requests == (1, AMOUNT)
+    assert balance == BALANCE - AMOUNT
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class UserStore:
+    """
+    Регистрация пользователей для ensure_user_in_db.
+    Новый пользователь — один INSERT OR IGNORE (+ проводка рефереру в той же транзакции,
+    вставка строки гарантирует однократность). Известные профили держатся в памяти:
+    без изменений — никакой записи, изменения имени копятся в write-behind буфере
+    и сбрасываются групповым коммитом по таймеру или по размеру.
+    """
+
+    def __init__(self, database, ledger, counters, flush_interval=2.0, flush_size=200, cache_size=200000, ref_bonus=1):
+        self.database = database
+        self.ledger = ledger
+        self.counters = counters
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.cache_size = cache_size
+        self.ref_bonus = ref_bonus
+        self._known = OrderedDict()  # user_id -> (username, first_name)
+        self._dirty = {}  # user_id -> (username, first_name)
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.inserted = 0
+        self.unchanged = 0
+        self.flushed = 0
+
+    def _remember(self, user_id, profile):
+        self._known[user_id] = profile
+        self._known.move_to_end(user_id)
+        if len(self._known) > self.cache_size:
+            self._known.popitem(last=False)
+
+    async def ensure(self, user, ref_id=None):
+        """Возвращает True, если пользователь создан"""
+        user_id = user.id
+        profile = (user.username or "", user.first_name or "")
+        known = self._known.get(user_id)
+        if known is not None:
+            self._known.move_to_end(user_id)
+            if known != profile:
+                self._remember(user_id, profile)
+                self._mark_dirty(user_id, profile)
+            else:
+                self.unchanged += 1
+            return False
+
+        if ref_id == user_id:
+            ref_id = None
+        async with self.database.acquire() as db:
+            # ref_id пишется только если реферер существует
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, ref_id, created_at) "
+                "VALUES (?, ?, ?, (SELECT user_id FROM users WHERE user_id=?), ?) RETURNING ref_id",
+                (user_id, profile[0], profile[1], ref_id, int(time.time()))
+            )
+            row = await cur.fetchone()
+            await cur.close()
+            created = row is not None
+            # бонус — только реально записанному рефереру, а не любому id из ссылки
+            ref_id = row[0] if created else None
+            if created:
+                await self.counters.bump(db, "users")
+            if ref_id:
+                await db.execute("UPDATE users SET invited_count = invited_count + 1 WHERE user_id=?", (ref_id,))
+                await self.ledger.credit(db, ref_id, self.ref_bonus, "referral", str(user_id))
+            await db.commit()
+        self._remember(user_id, profile)
+        if created:
+            self.inserted += 1
+        else:
+            # строка уже была, но профиль в памяти не знали — обновление уйдёт условным UPDATE
+            self._mark_dirty(user_id, profile)
+        return created
+
+    def _mark_dirty(self, user_id, profile):
+        self._dirty[user_id] = profile
+        if len(self._dirty) >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            rows = [(u, f, uid, u, f) for uid, (u, f) in batch.items()]
+            try:
+                async with self.database.acquire() as db:
+                    await db.executemany(
+                        "UPDATE users SET username=?, first_name=? "
+                        "WHERE user_id=? AND (username IS NOT ? OR first_name IS NOT ?)",
+                        rows
+                    )
+                    await db.commit()
+            except Exception:
+                # вернём в буфер, более свежие значения не затираем
+                for uid, profile in batch.items():
+                    self._dirty.setdefault(uid, profile)
+                raise
+            self.flushed += len(rows)
+            return len(rows)
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("user profile flush failed")
+
+    def stats(self):
+        return {
+            "known": len(self._known),
+            "dirty": len(self._dirty),
+            "inserted": self.inserted,
+            "unchanged": self.unchanged,
+            "flushed": self.flushed,
+        }
@@ -0,0 +1,151 @@
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram.types import Update
+from aiogram.webhook.aiohttp_server import setup_application
+
+log = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def require_secret(host, secret, public=False):
+    """
+    Без секрета апдейт с любым from.id (в том числе админа) может прислать любой, кто достучится
+    до порта, — без WEBHOOK_SECRET слушать разрешено только loopback и без WEBHOOK_URL.
+    """
+    if not secret and (public or host not in LOOPBACK_HOSTS):
+        raise RuntimeError(
+            f"WEBHOOK_SECRET is required for a webhook on {host} "
+            f"{'with WEBHOOK_URL set' if public else '(only loopback may run without it)'}"
+        )
+
+
+def update_user_id(update):
+    """id отправителя апдейта — по нему апдейты одного пользователя идут в один воркер"""
+    event = update.event
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+class UpdateWorkers:
+    """
+    Ограниченные очереди апдейтов, разложенные по user_id, и по воркеру (asyncio-задаче) на очередь:
+    разные пользователи обрабатываются параллельно, апдейты одного — по порядку.
+    on_done(update) вызывается после обработки (в т.ч. неудачной).
+    """
+
+    def __init__(self, dp, bot, workers=8, queue_size=1000, on_done=None):
+        self.dp = dp
+        self.bot = bot
+        self.on_done = on_done
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self._tasks = []
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def submit(self, update):
+        self.received += 1
+        queue = self.queues[update_user_id(update) % len(self.queues)]
+        # очередь ограничена: при переполнении отправитель ждёт
+        await queue.put(update)
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                log.exception("update %s failed", update.update_id)
+            finally:
+                queue.task_done()
+                if self.on_done:
+                    self.on_done(update)
+
+    async def start_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def stop_workers(self, drain_timeout=10):
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("update queues not drained: %s", [q.qsize() for q in self.queues])
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "queue_depth": [q.qsize() for q in self.queues],
+        }
+
+
+class WebhookServer(UpdateWorkers):
+    """
+    Приём апдейтов через aiohttp вместо start_polling, обработка — через UpdateWorkers.
+    Для нагрузочного теста достаточно POST-ить синтетические апдейты на WEBHOOK_PATH.
+    """
+
+    def __init__(self, dp, bot, secret="", workers=8, queue_size=1000):
+        super().__init__(dp, bot, workers=workers, queue_size=queue_size)
+        self.secret = secret
+        self.rejected = 0
+
+    async def handle(self, request):
+        if self.secret:
+            token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token, self.secret):
+                self.rejected += 1
+                return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception:
+            self.rejected += 1
+            return web.Response(status=400)
+        # при переполнении ответ задерживается и Telegram притормаживает
+        await self.submit(update)
+        return web.Response()
+
+    def make_app(self, path):
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        # воркеры стартуют после startup диспетчера и дочищают очереди до его shutdown
+        app.on_shutdown.append(self._on_shutdown)
+        setup_application(app, self.dp, bot=self.bot)
+        app.on_startup.append(self._on_startup)
+        return app
+
+    async def _on_startup(self, app):
+        await self.start_workers()
+
+    async def _on_shutdown(self, app):
+        await self.stop_workers()
+
+    async def run(self, host, port, path):
+        require_secret(host, self.secret)
+        runner = web.AppRunner(self.make_app(path))
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    def stats(self):
+        return dict(super().stats(), rejected=self.rejected)
@@ -0,0 +1,115 @@
+import logging
+import time
+
+from ledger import replayed_update, mark_update
+
+log = logging.getLogger(__name__)
+
+# статусы заявки
+WD_PENDING = "pending"
+WD_APPROVED = "approved"
+WD_REJECTED = "rejected"
+
+
+class Withdrawals:
+    """
+    Заявки на вывод звёзд. Звёзды списываются сразу при создании заявки (проводка withdraw
+    в той же транзакции, что и INSERT, баланс проверяется под блокировкой записи),
+    при отклонении возвращаются проводкой withdraw_refund. Админ разбирает очередь
+    страницами (keyset по id) и одобряет/отклоняет страницу целиком одной транзакцией.
+    """
+
+    def __init__(self, database, ledger):
+        self.database = database
+        self.ledger = ledger
+        self.requested = 0
+        self.insufficient = 0
+        self.replayed = 0
+        self.approved = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batch_total = 0.0
+
+    async def request(self, user_id, amount, update_id=None):
+        """
+        id заявки или None, если звёзд не хватает. При повторной доставке того же апдейта
+        (update_id) возвращается id уже созданной заявки, второго списания нет.
+        """
+        if amount <= 0:
+            raise ValueError(f"withdrawal amount must be positive: {amount}")
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            replayed = await replayed_update(db, update_id)
+            if replayed is not None:
+                await db.rollback()
+                self.replayed += 1
+                return int(replayed)
+            cur = await db.execute(
+                "INSERT INTO withdrawals (user_id, amount, status, created_at) VALUES (?, ?, ?, ?)",
+                (user_id, amount, WD_PENDING, int(time.time()))
+            )
+            request_id = cur.lastrowid
+            if not await self.ledger.debit(db, user_id, amount, "withdraw", str(request_id)):
+                await db.rollback()
+                self.insufficient += 1
+                return None
+            await mark_update(db, update_id, request_id)
+            await db.commit()
+        self.requested += 1
+        return request_id
+
+    async def pending_page(self, after_id=0, limit=20):
+        """Следующие limit ожидающих заявок после after_id и общее число ожидающих"""
+        async with self.database.acquire() as db:
+            cur = await db.execute(
+                "SELECT id, user_id, amount, created_at FROM withdrawals "
+                "WHERE status=? AND id > ? ORDER BY id LIMIT ?",
+                (WD_PENDING, after_id, limit)
+            )
+            rows = await cur.fetchall()
+            cur = await db.execute("SELECT count(*), coalesce(sum(amount), 0) FROM withdrawals WHERE status=?", (WD_PENDING,))
+            count, total = await cur.fetchone()
+        return rows, count, total
+
+    async def process_range(self, after_id, last_id, approve, admin_id):
+        """
+        Одобряет/отклоняет все ожидающие заявки с after_id < id <= last_id — то есть ровно ту
+        страницу, что видел админ (новые заявки получают id больше last_id).
+        Одна транзакция; при отклонении звёзды возвращаются. Возвращает [(id, user_id, amount)].
+        """
+        started = time.perf_counter()
+        status = WD_APPROVED if approve else WD_REJECTED
+        async with self.database.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute(
+                "UPDATE withdrawals SET status=?, processed_at=?, processed_by=? "
+                "WHERE status=? AND id > ? AND id <= ? RETURNING id, user_id, amount",
+                (status, int(time.time()), admin_id, WD_PENDING, after_id, last_id)
+            )
+            rows = await cur.fetchall()
+            if rows and not approve:
+                await self.ledger.credit_many(
+                    db, [(user_id, amount, str(wd_id)) for wd_id, user_id, amount in rows], "withdraw_refund"
+                )
+            await db.commit()
+        elapsed = time.perf_counter() - started
+        if approve:
+            self.approved += len(rows)
+        else:
+            self.rejected += len(rows)
+        self.batches += 1
+        self.batch_total += elapsed
+        log.info("withdrawals %s: %s requests in %.1f ms", status, len(rows), elapsed * 1000)
+        return sorted(rows), elapsed
+
+    def stats(self):
+        processed = self.approved + self.rejected
+        return {
+            "requested": self.requested,
+            "insufficient": self.insufficient,
+            "replayed": self.replayed,
+            "approved": self.approved,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "batch_rate": processed / self.batch_total if self.batch_total > 0 else 0.0,
+        }